@@ -3,13 +3,19 @@
 {
     "name": "Coupons multi product criteria",
     "summary": "Allows to set as promotion criteria multi-product conditions",
-    "version": "13.0.1.0.0",
+    "version": "13.0.1.1.0",
     "development_status": "Production/Stable",
     "category": "Sale",
     "website": "https://github.com/OCA/sale-promotion",
     "author": "Tecnativa, Odoo Community Association (OCA)",
     "maintainers": ["chienandalu"],
     "license": "AGPL-3",
-    "depends": ["sale_coupon"],
-    "data": ["views/sale_coupon_program_views.xml", "security/ir.model.access.csv"],
+    "depends": ["sale_coupon_profiling"],
+    "data": [
+        "data/ir_cron_data.xml",
+        "views/sale_coupon_program_views.xml",
+        "views/sale_coupon_recompute_job_views.xml",
+        "views/sale_coupon_program_overlap_views.xml",
+        "security/ir.model.access.csv",
+    ],
 }
@@ -1,2 +1,4 @@
 from . import sale_coupon_criteria
 from . import sale_coupon_program
+from . import sale_coupon_program_overlap
+from . import sale_coupon_recompute_job
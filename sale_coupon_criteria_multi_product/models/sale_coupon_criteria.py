@@ -1,14 +1,68 @@
 # Copyright 2021 Tecnativa - David Vidal
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
-from odoo import _, api, fields, models
+import hashlib
+import uuid
+from collections import Counter, defaultdict
+
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import ValidationError
+from odoo.tools import split_every
+
+from odoo.addons.sale_coupon_profiling.transaction_buffer import TransactionBuffer
+
+# Rows inserted at once by the criterias bulk creation
+BULK_BATCH_SIZE = 10000
+
+
+def _write_selectivity_stats(cr, stats):
+    """Add the checks results to the criterias counters. The criterias are updated
+    following their ids, so concurrent writes wait for each other instead of
+    deadlocking.
+
+    :param stats: Counter (criteria id, counter field name) -> checks
+    """
+    counters = defaultdict(lambda: dict.fromkeys(["hit", "miss", "skip"], 0))
+    for (criteria_id, field_name), count in stats.items():
+        # Skip not yet saved criterias
+        if not isinstance(criteria_id, int):
+            continue
+        counters[criteria_id][field_name[: -len("_count")]] += count
+    if not counters:
+        return
+    criteria_ids = sorted(counters)
+    cr.execute(
+        """
+        UPDATE sale_coupon_criteria c
+        SET hit_count = COALESCE(c.hit_count, 0) + v.hit,
+            miss_count = COALESCE(c.miss_count, 0) + v.miss,
+            skip_count = COALESCE(c.skip_count, 0) + v.skip
+        FROM unnest(%s, %s, %s, %s) AS v(id, hit, miss, skip)
+        WHERE c.id = v.id
+        """,
+        (
+            criteria_ids,
+            [counters[criteria_id]["hit"] for criteria_id in criteria_ids],
+            [counters[criteria_id]["miss"] for criteria_id in criteria_ids],
+            [counters[criteria_id]["skip"] for criteria_id in criteria_ids],
+        ),
+    )
+
+
+# Criterias checks results not written yet, so the checks don't write on the
+# criterias themselves. They're written once the transaction checking them ends.
+_selectivity_stats = TransactionBuffer(
+    "Coupon criterias checks stats",
+    _write_selectivity_stats,
+    Counter,
+    events=("commit", "rollback"),
+)
 
 
 class SaleCouponCriteria(models.Model):
     _name = "sale.coupon.criteria"
     _description = "Coupon Multi Product Criteria"
 
-    program_id = fields.Many2one(comodel_name="sale.coupon.program",)
+    program_id = fields.Many2one(comodel_name="sale.coupon.program", index=True)
     rule_min_quantity = fields.Integer(
         string="Min. Quantity",
         compute="_compute_rule_min_quantity",
@@ -22,6 +76,34 @@ class SaleCouponCriteria(models.Model):
     repeat_product = fields.Boolean(
         string="Repeat", help="Can product quantities count multiple times or not",
     )
+    hit_count = fields.Integer(
+        string="Hits",
+        readonly=True,
+        copy=False,
+        help="Times this criteria has been checked and fulfilled",
+    )
+    miss_count = fields.Integer(
+        string="Misses",
+        readonly=True,
+        copy=False,
+        help="Times this criteria has been checked and not fulfilled",
+    )
+    skip_count = fields.Integer(
+        string="Skips",
+        readonly=True,
+        copy=False,
+        help="Times this criteria hasn't been checked as a previous criteria of "
+        "the program wasn't fulfilled",
+    )
+    miss_rate = fields.Float(
+        compute="_compute_miss_rate", help="Ratio of checks not fulfilled",
+    )
+    fingerprint = fields.Char(
+        compute="_compute_fingerprint",
+        store=True,
+        index=True,
+        help="Criterias with the same fingerprint are fulfilled by the same orders",
+    )
 
     @api.depends("product_ids", "repeat_product")
     def _compute_rule_min_quantity(self):
@@ -30,6 +112,30 @@ class SaleCouponCriteria(models.Model):
         for criteria in self.filtered(lambda x: not x.repeat_product):
             criteria.rule_min_quantity = len(criteria.product_ids)
 
+    @api.depends("product_ids", "repeat_product", "rule_min_quantity")
+    def _compute_fingerprint(self):
+        for criteria in self:
+            criteria.fingerprint = self._get_fingerprint(
+                criteria.product_ids.ids,
+                criteria.repeat_product,
+                criteria.rule_min_quantity,
+            )
+
+    @api.model
+    def _get_fingerprint(self, product_ids, repeat_product, rule_min_quantity):
+        key = "%s|%s|%s" % (
+            bool(repeat_product),
+            rule_min_quantity or 0,
+            ",".join(str(x) for x in sorted(product_ids)),
+        )
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @api.depends("hit_count", "miss_count")
+    def _compute_miss_rate(self):
+        for criteria in self:
+            checks = criteria.hit_count + criteria.miss_count
+            criteria.miss_rate = checks and criteria.miss_count / checks
+
     @api.constrains("rule_min_quantity")
     def _check_rule_min_qty(self):
         for criteria in self.filtered(lambda x: not x.repeat_product):
@@ -40,3 +146,241 @@ class SaleCouponCriteria(models.Model):
                         "products. Set the rule as repeatable to avoid this constraint."
                     )
                 )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.clear_caches()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if set(vals) - {"hit_count", "miss_count", "skip_count"}:
+            self.clear_caches()
+        return super().write(vals)
+
+    def unlink(self):
+        self.clear_caches()
+        return super().unlink()
+
+    @api.model
+    def create_bulk(self, vals_list):
+        """Create many criterias at once with plain SQL, for big imports. The
+        values are checked all together, the products relation rows are inserted
+        in batches and the computed fields are worked out on the way.
+
+        :param vals_list: list of dicts with the keys ``program_id``,
+          ``product_ids`` (list of product ids), ``repeat_product`` and
+          ``rule_min_quantity``, which is the number of products when not repeated.
+        :return: list of ids of the new criterias
+        """
+        self.check_access_rights("create")
+        if not vals_list:
+            return []
+        program_ids = {vals.get("program_id") for vals in vals_list} - {None, False}
+        programs = self.env["sale.coupon.program"].browse(program_ids)
+        programs.check_access_rights("write")
+        programs.check_access_rule("write")
+        if len(programs.exists()) != len(programs):
+            raise ValidationError(_("Some of the criterias programs don't exist."))
+        for vals in vals_list:
+            product_ids = vals.get("product_ids")
+            if not product_ids:
+                raise ValidationError(_("Every criteria needs some products."))
+            if not isinstance(product_ids, list) or not all(
+                isinstance(product_id, int) and not isinstance(product_id, bool)
+                for product_id in product_ids
+            ):
+                raise ValidationError(
+                    _("The criterias products must be given as a list of ids.")
+                )
+        products = self.env["product.product"].browse(
+            {product_id for vals in vals_list for product_id in vals["product_ids"]}
+        )
+        if len(products.exists()) != len(products):
+            raise ValidationError(_("Some of the criterias products don't exist."))
+        # Write every pending change, of the criterias and the programs among
+        # others, before the rows are inserted behind the ORM back
+        self.flush()
+        cr = self.env.cr
+        cr.execute(
+            "SELECT nextval(%s) FROM generate_series(1, %s)",
+            ("%s_id_seq" % self._table, len(vals_list)),
+        )
+        ids = [row[0] for row in cr.fetchall()]
+        rows = []
+        for position, vals in enumerate(vals_list):
+            product_ids = sorted(set(vals["product_ids"]))
+            repeat = bool(vals.get("repeat_product"))
+            min_qty = vals.get("rule_min_quantity")
+            if not repeat:
+                if min_qty and min_qty != len(product_ids):
+                    raise ValidationError(
+                        _(
+                            "The minimum quantity can't be different from the number "
+                            "of products. Set the rule as repeatable to avoid this "
+                            "constraint."
+                        )
+                    )
+                min_qty = len(product_ids)
+            rows.append(
+                (
+                    ids[position],
+                    vals.get("program_id") or None,
+                    min_qty or 0,
+                    repeat,
+                    self._get_fingerprint(product_ids, repeat, min_qty),
+                    product_ids,
+                )
+            )
+        for batch in split_every(BULK_BATCH_SIZE, rows):
+            cr.execute(
+                """
+                INSERT INTO sale_coupon_criteria (id, program_id, rule_min_quantity,
+                    repeat_product, fingerprint, create_uid, create_date, write_uid,
+                    write_date)
+                SELECT v.id, v.program_id, v.rule_min_quantity, v.repeat_product,
+                    v.fingerprint, %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s,
+                    now() AT TIME ZONE 'UTC'
+                FROM unnest(%(ids)s::integer[], %(program_ids)s::integer[],
+                    %(min_qties)s::integer[], %(repeats)s::boolean[],
+                    %(fingerprints)s::varchar[])
+                    AS v(id, program_id, rule_min_quantity, repeat_product,
+                        fingerprint)
+                """,
+                {
+                    "uid": self.env.uid,
+                    "ids": [row[0] for row in batch],
+                    "program_ids": [row[1] for row in batch],
+                    "min_qties": [row[2] for row in batch],
+                    "repeats": [row[3] for row in batch],
+                    "fingerprints": [row[4] for row in batch],
+                },
+            )
+        relation_rows = ((row[0], product_id) for row in rows for product_id in row[5])
+        for batch in split_every(BULK_BATCH_SIZE, relation_rows):
+            cr.execute(
+                """
+                INSERT INTO product_product_sale_coupon_criteria_rel
+                    (sale_coupon_criteria_id, product_product_id)
+                SELECT * FROM unnest(%s::integer[], %s::integer[])
+                """,
+                ([row[0] for row in batch], [row[1] for row in batch]),
+            )
+        self.clear_caches()
+        self.invalidate_cache()
+        return ids
+
+    @api.model
+    @tools.ormcache()
+    def _get_multi_product_index(self):
+        """Inverted index of the multi product criterias. It's built once per
+        registry and invalidated whenever a criteria or a program is written, so the
+        programs filter only has to look at the criterias containing ordered products.
+
+        :return: dict with the keys:
+          - ``generation``: token telling apart every build of the index.
+          - ``product_criterias``: product id -> frozenset of criteria ids.
+          - ``criterias``: criteria id -> (min qty, repeat, number of products).
+          - ``criteria_products``: criteria id -> frozenset of product ids.
+          - ``criteria_fingerprints``: criteria id -> fingerprint.
+          - ``criteria_ranks``: criteria id -> position in which it's checked
+            within its program, as sorted by `_get_selectivity_key`.
+        """
+        self.flush(
+            [
+                "program_id",
+                "rule_min_quantity",
+                "repeat_product",
+                "product_ids",
+                "hit_count",
+                "miss_count",
+                "fingerprint",
+            ]
+        )
+        self.env.cr.execute(
+            """
+            SELECT c.id, c.program_id, c.rule_min_quantity, c.repeat_product,
+                c.hit_count, c.miss_count, c.fingerprint,
+                array_agg(rel.product_product_id)
+            FROM sale_coupon_criteria c
+            JOIN product_product_sale_coupon_criteria_rel rel
+                ON rel.sale_coupon_criteria_id = c.id
+            WHERE c.program_id IS NOT NULL
+            GROUP BY c.id
+            """
+        )
+        use_stats = self._is_selectivity_stats_enabled()
+        product_criterias = defaultdict(set)
+        program_criterias = defaultdict(list)
+        criterias = {}
+        criteria_products = {}
+        criteria_fingerprints = {}
+        for row in self.env.cr.fetchall():
+            (
+                criteria_id,
+                program_id,
+                min_qty,
+                repeat,
+                hits,
+                misses,
+                fingerprint,
+                product_ids,
+            ) = row
+            criteria_fingerprints[criteria_id] = fingerprint
+            criterias[criteria_id] = (min_qty or 0, bool(repeat), len(product_ids))
+            criteria_products[criteria_id] = frozenset(product_ids)
+            for product_id in product_ids:
+                product_criterias[product_id].add(criteria_id)
+            program_criterias[program_id].append(
+                (
+                    self._get_selectivity_key(
+                        criterias[criteria_id],
+                        hits or 0 if use_stats else 0,
+                        misses or 0 if use_stats else 0,
+                    ),
+                    criteria_id,
+                )
+            )
+        return {
+            "generation": uuid.uuid4().hex,
+            "product_criterias": {
+                product_id: frozenset(criteria_ids)
+                for product_id, criteria_ids in product_criterias.items()
+            },
+            "criterias": criterias,
+            "criteria_products": criteria_products,
+            "criteria_fingerprints": criteria_fingerprints,
+            "criteria_ranks": {
+                criteria_id: position
+                for ranked_criterias in program_criterias.values()
+                for position, (_key, criteria_id) in enumerate(sorted(ranked_criterias))
+            },
+        }
+
+    @api.model
+    def _get_selectivity_key(self, criteria_data, hits, misses):
+        """Sort key to check first the criterias most likely to fail: the most
+        failing ones when the checks stats are collected and then those with fewer
+        products and higher minimum quantities.
+
+        :param criteria_data: tuple (min qty, repeat, number of products)
+        """
+        min_qty, _repeat, products_count = criteria_data
+        checks = hits + misses
+        return (-(checks and misses / checks), products_count, -min_qty)
+
+    @api.model
+    def _is_selectivity_stats_enabled(self):
+        return bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("sale_coupon_criteria_multi_product.selectivity_stats")
+        )
+
+    @api.model
+    def _add_selectivity_stats(self, stats):
+        """Buffer the criterias checks results, which are written once the current
+        transaction is committed or rolled back.
+
+        :param stats: Counter (criteria id, counter field name) -> checks
+        """
+        _selectivity_stats.add(self.env.cr, lambda buffered: buffered.update(stats))
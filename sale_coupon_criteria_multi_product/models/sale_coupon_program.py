@@ -1,6 +1,53 @@
 # Copyright 2021 Tecnativa - David Vidal
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
-from odoo import api, fields, models
+from collections import Counter, defaultdict
+
+from odoo import api, fields, models, tools
+from odoo.tools import split_every
+from odoo.tools.lru import LRU
+from odoo.tools.safe_eval import safe_eval
+
+from odoo.addons.sale_coupon_profiling.profiler import profiled
+
+# Last multi product criterias results of every order, so they're only checked
+# again when the quantities of their products change
+_results_cache = LRU(4096)
+
+# Quotations customers checked at once against a partners domain to recompute them
+RECOMPUTE_PARTNERS_BATCH_SIZE = 10000
+
+# Historical orders replayed at once by the programs simulation
+SIMULATION_BATCH_SIZE = 5000
+
+
+class ProgramRules:
+    """Program settings the products filter depends on, compiled once per registry
+    for all the active programs so they aren't read again for every order."""
+
+    __slots__ = (
+        "sale_coupon_criteria",
+        "criteria_ids",
+        "promo_applicability",
+        "reward_type",
+        "reward_product_id",
+        "reward_product_quantity",
+    )
+
+    def __init__(
+        self,
+        sale_coupon_criteria,
+        criteria_ids,
+        promo_applicability,
+        reward_type,
+        reward_product_id,
+        reward_product_quantity,
+    ):
+        self.sale_coupon_criteria = sale_coupon_criteria
+        self.criteria_ids = criteria_ids
+        self.promo_applicability = promo_applicability
+        self.reward_type = reward_type
+        self.reward_product_id = reward_product_id
+        self.reward_product_quantity = reward_product_quantity
 
 
 class SaleCouponProgram(models.Model):
@@ -20,12 +67,96 @@ class SaleCouponProgram(models.Model):
         inverse_name="program_id",
     )
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env["sale.coupon.criteria"].clear_caches()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        # The criterias results and the programs rules depend on these fields
+        if {
+            "active",
+            "sale_coupon_criteria",
+            "sale_coupon_criteria_ids",
+            "promo_applicability",
+            "reward_type",
+            "reward_product_id",
+            "reward_product_quantity",
+        } & set(vals):
+            self.env["sale.coupon.criteria"].clear_caches()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env["sale.coupon.criteria"].clear_caches()
+        return super().unlink()
+
+    @api.model
+    @tools.ormcache()
+    def _get_programs_rules(self):
+        """Rules of all the active programs, read at once and cached in every
+        process until a program or a criteria is created, written or deleted. The
+        registry signaling spreads the invalidation to the other workers.
+
+        :return: dict program id -> `ProgramRules`
+        """
+        self.flush(
+            [
+                "active",
+                "sale_coupon_criteria",
+                "promo_applicability",
+                "reward_type",
+                "reward_product_id",
+                "reward_product_quantity",
+            ]
+        )
+        self.env["sale.coupon.criteria"].flush(["program_id"])
+        self.env.cr.execute(
+            """
+            SELECT p.id, p.sale_coupon_criteria, p.promo_applicability, p.reward_type,
+                p.reward_product_id, p.reward_product_quantity,
+                array_remove(array_agg(c.id ORDER BY c.id), NULL)
+            FROM sale_coupon_program p
+            LEFT JOIN sale_coupon_criteria c ON c.program_id = p.id
+            WHERE p.active
+            GROUP BY p.id
+            """
+        )
+        return {
+            row[0]: ProgramRules(
+                row[1] or "domain", tuple(row[6]), row[2], row[3], row[4], row[5] or 0
+            )
+            for row in self.env.cr.fetchall()
+        }
+
+    def _get_rules(self):
+        """Compiled rules of the program, or of its current values when it isn't
+        compiled (i.e.: archived or new programs)
+
+        :return: `ProgramRules`
+        """
+        self.ensure_one()
+        rules = self._get_programs_rules().get(self.id)
+        if rules is None:
+            rules = ProgramRules(
+                self.sale_coupon_criteria or "domain",
+                tuple(self.sale_coupon_criteria_ids.ids),
+                self.promo_applicability,
+                self.reward_type,
+                self.reward_product_id.id,
+                self.reward_product_quantity,
+            )
+        return rules
+
     @api.onchange("sale_coupon_criteria")
     def _onchange_sale_coupon_criteria(self):
         """Clear domain so we clear some other fields from the view"""
         if self.sale_coupon_criteria == "multi_product":
             self.rule_products_domain = False
 
+    @profiled(
+        programs=lambda self, order, result: self,
+        records=lambda self, order, result: order.order_line,
+    )
     def _filter_programs_on_products(self, order):
         """
         After splitting the programs according to their criteria, we'll check the rules
@@ -35,9 +166,12 @@ class SaleCouponProgram(models.Model):
         - No repeat: one unit every product in the criteria.
         All the criterias defined in a program must be fulfilled.
         """
-        domain_programs = self.filtered(lambda x: x.sale_coupon_criteria == "domain")
+        programs_rules = {program: program._get_rules() for program in self}
+        domain_programs = self.filtered(
+            lambda x: programs_rules[x].sale_coupon_criteria == "domain"
+        )
         multi_product_programs = (self - domain_programs).filtered(
-            "sale_coupon_criteria_ids"
+            lambda x: programs_rules[x].criteria_ids
         )
         # We'll return them altogether
         valid_domain_criteria_programs = super(
@@ -51,41 +185,614 @@ class SaleCouponProgram(models.Model):
         products_qties = dict.fromkeys(products, 0)
         for line in order_lines:
             products_qties[line.product_id] += line.product_uom_qty
+        criteria_obj = self.env["sale.coupon.criteria"]
+        index = criteria_obj._get_multi_product_index()
+        # Reuse the results of the criterias not affected by the changes in the
+        # order since the last check
+        results = self._get_multi_product_cached_results(order, products_qties, index)
+        matched_criterias = None
+        # Criterias with the same fingerprint are checked once
+        shared_results = {}
+        stats = Counter() if criteria_obj._is_selectivity_stats_enabled() else None
         valid_multi_product_criteria_programs = multi_product_programs
         for program in multi_product_programs:
             criterias_are_valid = True
-            for criteria in program.sale_coupon_criteria_ids:
-                valid_products = program._get_valid_products_multi_product(
-                    products, criteria
+            # Check first the criterias more likely to fail
+            criterias = self.env["sale.coupon.criteria"].browse(
+                sorted(
+                    programs_rules[program].criteria_ids,
+                    key=lambda x: index["criteria_ranks"].get(x, 0),
                 )
-                if not valid_products:
-                    criterias_are_valid = False
-                    break
-                ordered_rule_products_qty = sum(
-                    products_qties[p] for p in valid_products
+            )
+            for criteria in criterias:
+                criterias_are_valid = results.get(criteria.id)
+                shared_key = self._get_criteria_shared_key(
+                    criteria.id, programs_rules[program], index
                 )
-                # Avoid program if 1 ordered foo on a program '1 foo, 1 free foo'
-                # as it's done in the standard
-                if (
-                    program.promo_applicability == "on_current_order"
-                    and program.reward_type == "product"
-                    and program.reward_product_id in criteria.product_ids
-                ):
-                    ordered_rule_products_qty -= program.reward_product_quantity
-                if ordered_rule_products_qty < criteria.rule_min_quantity:
-                    criterias_are_valid = False
+                if criterias_are_valid is None and shared_key:
+                    criterias_are_valid = shared_results.get(shared_key)
+                    if criterias_are_valid is not None:
+                        results[criteria.id] = criterias_are_valid
+                if criterias_are_valid is None:
+                    if matched_criterias is None:
+                        matched_criterias = self._get_matched_multi_product_criterias(
+                            {p.id: qty for p, qty in products_qties.items()}, index
+                        )
+                    criterias_are_valid = program._check_multi_product_criteria(
+                        criteria, products, products_qties, index, matched_criterias
+                    )
+                    results[criteria.id] = criterias_are_valid
+                    # Only the criterias actually checked are counted
+                    if stats is not None:
+                        stats[
+                            criteria.id,
+                            "hit_count" if criterias_are_valid else "miss_count",
+                        ] += 1
+                if shared_key:
+                    shared_results[shared_key] = criterias_are_valid
+                if not criterias_are_valid:
                     break
             if not criterias_are_valid:
                 valid_multi_product_criteria_programs -= program
+            if stats is not None and not criterias_are_valid:
+                # The loop stopped at the failed criteria
+                position = criterias.ids.index(criteria.id)
+                for skipped in criterias[position + 1 :]:
+                    stats[skipped.id, "skip_count"] += 1
+        if stats:
+            criteria_obj._add_selectivity_stats(stats)
+        self._set_multi_product_cached_results(order, products_qties, index, results)
         return valid_domain_criteria_programs + valid_multi_product_criteria_programs
 
+    @api.model
+    def _get_criteria_shared_key(self, criteria_id, rules, index):
+        """Key of the criteria result shared by the criterias of any program: its
+        fingerprint and the reward quantity deducted from it.
+
+        :param rules: `ProgramRules` of the criteria program
+        :return: tuple or None for criterias not indexed yet (i.e.: new records)
+        """
+        fingerprint = index["criteria_fingerprints"].get(criteria_id)
+        if not fingerprint:
+            return None
+        deduction = 0
+        if (
+            rules.promo_applicability == "on_current_order"
+            and rules.reward_type == "product"
+            and rules.reward_product_id in index["criteria_products"][criteria_id]
+        ):
+            deduction = rules.reward_product_quantity
+        return fingerprint, deduction
+
+    def _check_multi_product_criteria(
+        self, criteria, products, products_qties, index, matched_criterias
+    ):
+        """Check if the ordered products fulfill a criteria of the program.
+
+        :param products: ordered products
+        :param products_qties: dict product -> ordered quantity
+        :param index: criterias index as returned by `_get_multi_product_index`
+        :param matched_criterias: as returned by `_get_matched_multi_product_criterias`
+        :return: whether the criteria is fulfilled or not
+        """
+        self.ensure_one()
+        # Criterias not indexed yet (i.e.: new records) are fully checked
+        if criteria.id in index["criterias"] and criteria.id not in matched_criterias:
+            return False
+        valid_products = self._get_valid_products_multi_product(products, criteria)
+        if not valid_products:
+            return False
+        ordered_rule_products_qty = sum(products_qties[p] for p in valid_products)
+        rules = self._get_rules()
+        # Avoid program if 1 ordered foo on a program '1 foo, 1 free foo'
+        # as it's done in the standard
+        if (
+            rules.promo_applicability == "on_current_order"
+            and rules.reward_type == "product"
+            and rules.reward_product_id in self._get_criteria_product_ids(criteria)
+        ):
+            ordered_rule_products_qty -= rules.reward_product_quantity
+        return ordered_rule_products_qty >= criteria.rule_min_quantity
+
+    @api.model
+    def _get_multi_product_cached_results(self, order, products_qties, index):
+        """Criterias results of the last check of the order that are still valid:
+        those of the criterias without any product whose ordered quantity changed
+        since then. They're dropped altogether when the index is rebuilt.
+
+        :param products_qties: dict product -> ordered quantity
+        :return: dict criteria id -> whether it's fulfilled or not
+        """
+        order_id = order._origin.id
+        cached = order_id and _results_cache.get((self.env.cr.dbname, order_id))
+        if not cached or cached[0] != index["generation"]:
+            return {}
+        _generation, last_qties, results = cached
+        qties = {p.id: qty for p, qty in products_qties.items()}
+        changed_criterias = set()
+        for product_id in set(qties) | set(last_qties):
+            if qties.get(product_id) != last_qties.get(product_id):
+                changed_criterias.update(index["product_criterias"].get(product_id, ()))
+        return {
+            criteria_id: result
+            for criteria_id, result in results.items()
+            if criteria_id not in changed_criterias
+        }
+
+    @api.model
+    def _set_multi_product_cached_results(self, order, products_qties, index, results):
+        """Keep the criterias results along with the ordered quantities they come
+        from, so the next check of the order only evaluates the affected ones. Only
+        the index generation is kept, so the cache doesn't hold former indexes."""
+        order_id = order._origin.id
+        if not order_id:
+            return
+        _results_cache[self.env.cr.dbname, order_id] = (
+            index["generation"],
+            {p.id: qty for p, qty in products_qties.items()},
+            {
+                criteria_id: result
+                for criteria_id, result in results.items()
+                if criteria_id in index["criterias"]
+            },
+        )
+
+    def _filter_programs_on_orders(self, orders):
+        """Batch version of `_filter_programs_on_products` for stored orders. The
+        ordered quantities of all of them are read at once and every multi product
+        criteria is checked against them through the criterias index, with the same
+        repeat and reward product rules.
+
+        :return: dict order id -> valid programs
+        """
+        programs_rules = {program: program._get_rules() for program in self}
+        domain_programs = self.filtered(
+            lambda x: programs_rules[x].sale_coupon_criteria == "domain"
+        )
+        multi_product_programs = (self - domain_programs).filtered(
+            lambda x: programs_rules[x].criteria_ids
+        )
+        index = self.env["sale.coupon.criteria"]._get_multi_product_index()
+        deductions = multi_product_programs._get_multi_product_deductions(index)
+        programs_criterias = {
+            program.id: set(programs_rules[program].criteria_ids)
+            for program in multi_product_programs
+        }
+        orders_products_qties = self._get_orders_products_qties(orders)
+        valid_programs = {}
+        for order in orders:
+            matched_criterias = self._get_matched_multi_product_criterias(
+                orders_products_qties.get(order.id, {}), index, deductions
+            )
+            programs = self.browse(
+                [
+                    program_id
+                    for program_id, criterias in programs_criterias.items()
+                    if criterias <= matched_criterias
+                ]
+            )
+            if domain_programs:
+                programs = (
+                    domain_programs._filter_programs_on_products(order) + programs
+                )
+            valid_programs[order.id] = programs
+        return valid_programs
+
+    @api.model
+    def _get_orders_products_qties(self, orders):
+        """Ordered quantities of every product, without reward lines, as a sparse
+        orders x products matrix.
+
+        :return: dict order id -> dict product id -> ordered quantity
+        """
+        self.env["sale.order.line"].flush(
+            ["order_id", "product_id", "product_uom_qty", "is_reward_line"]
+        )
+        self.env.cr.execute(
+            """
+            SELECT order_id, product_id, SUM(product_uom_qty)
+            FROM sale_order_line
+            WHERE order_id IN %s
+                AND product_id IS NOT NULL
+                AND is_reward_line IS NOT TRUE
+            GROUP BY order_id, product_id
+            """,
+            (tuple(orders.ids) or (None,),),
+        )
+        orders_products_qties = defaultdict(dict)
+        for order_id, product_id, qty in self.env.cr.fetchall():
+            orders_products_qties[order_id][product_id] = qty
+        return orders_products_qties
+
+    def _get_multi_product_deductions(self, index):
+        """Quantities to deduct from the criterias containing the reward product of
+        their program, so 1 ordered foo doesn't fulfill a '1 foo, 1 free foo'
+        program.
+
+        :return: dict criteria id -> quantity to deduct
+        """
+        deductions = {}
+        for program in self:
+            rules = program._get_rules()
+            if (
+                rules.promo_applicability != "on_current_order"
+                or rules.reward_type != "product"
+            ):
+                continue
+            reward_criterias = index["product_criterias"].get(
+                rules.reward_product_id, ()
+            )
+            for criteria_id in rules.criteria_ids:
+                if criteria_id in reward_criterias:
+                    deductions[criteria_id] = rules.reward_product_quantity
+        return deductions
+
+    def _get_matched_multi_product_criterias(
+        self, products_qties, index, deductions=None
+    ):
+        """Use the criterias index to tell which ones could be fulfilled by the given
+        product quantities. Only the criterias containing any of the products are
+        looked at. Those not repeating products must contain all of them and none can
+        be fulfilled below its minimum quantity.
+
+        :param products_qties: dict product id -> ordered quantity
+        :param index: criterias index as returned by `_get_multi_product_index`
+        :param deductions: optional dict criteria id -> quantity to deduct as
+          returned by `_get_multi_product_deductions`
+        :return: set of ids of the criterias that could be fulfilled
+        """
+        deductions = deductions or {}
+        matched_products = defaultdict(int)
+        matched_qties = defaultdict(float)
+        for product_id, qty in products_qties.items():
+            for criteria_id in index["product_criterias"].get(product_id, ()):
+                matched_products[criteria_id] += 1
+                matched_qties[criteria_id] += qty
+        matched_criterias = set()
+        for criteria_id, matched in matched_products.items():
+            min_qty, repeat, products_count = index["criterias"][criteria_id]
+            if not repeat and matched < products_count:
+                continue
+            if matched_qties[criteria_id] - deductions.get(criteria_id, 0) < min_qty:
+                continue
+            matched_criterias.add(criteria_id)
+        return matched_criterias
+
+    def _get_criteria_product_ids(self, criteria):
+        """Product ids of the criteria, taken from the criterias index unless it
+        isn't indexed yet (i.e.: new records).
+
+        :return: frozenset of product ids
+        """
+        index = self.env["sale.coupon.criteria"]._get_multi_product_index()
+        product_ids = index["criteria_products"].get(criteria.id)
+        if product_ids is None:
+            product_ids = frozenset(criteria.product_ids.ids)
+        return product_ids
+
     def _get_valid_products_multi_product(self, products, criteria):
         """Return valid products depending on the criteria repeat product setting. Then
         the main method will check if the minimum quantities are acomplished."""
-        if criteria.repeat_product:
-            return products.browse(
-                [x.id for x in criteria.product_ids if x in products]
-            )
-        if not all([x in products for x in criteria.product_ids]):
+        criteria_product_ids = self._get_criteria_product_ids(criteria)
+        valid_product_ids = criteria_product_ids.intersection(products.ids)
+        if not criteria.repeat_product and valid_product_ids != criteria_product_ids:
             return self.env["product.product"]
-        return criteria.product_ids
+        return products.browse(valid_product_ids)
+
+    def _get_recompute_orders(self):
+        """Quotations which promotions could change with the programs changes, all
+        of them selected in a single query: those already rewarded by any of the
+        programs and those with any product of the programs criterias or products
+        domain, from partners matching their partners domain. Programs with the
+        same products and partners domain are checked once, and every distinct
+        domain is evaluated once.
+        """
+        if not self:
+            return self.env["sale.order"]
+        self.flush()
+        index = self.env["sale.coupon.criteria"]._get_multi_product_index()
+        products_by_domain = {}
+        # Distinct tuples (product ids or None for any product, partners domain)
+        rules = set()
+        for program in self:
+            program_rules = program._get_rules()
+            if program_rules.sale_coupon_criteria == "multi_product":
+                product_ids = frozenset().union(
+                    *(
+                        index["criteria_products"].get(criteria_id, frozenset())
+                        for criteria_id in program_rules.criteria_ids
+                    )
+                )
+            else:
+                domain = program.rule_products_domain or "[]"
+                if domain not in products_by_domain:
+                    products_domain = safe_eval(domain)
+                    products_by_domain[domain] = (
+                        frozenset(
+                            self.env["product.product"].search(products_domain).ids
+                        )
+                        if products_domain
+                        else None
+                    )
+                product_ids = products_by_domain[domain]
+            rules.add((product_ids, program.rule_partners_domain or "[]"))
+        self.env["sale.order"].flush(["state", "partner_id"])
+        self.env["sale.order.line"].flush(["order_id", "product_id"])
+        partners_groups = self._get_recompute_partners_groups(
+            {domain for _product_ids, domain in rules}
+        )
+        params = {
+            "discount_product_ids": self.mapped("discount_line_product_id").ids,
+            "rule_ids": [],
+            "product_ids": [],
+            "any_product_rule_ids": [],
+            "restricted_rule_ids": [],
+            "rule_group_ids": [],
+            "group_ids": [],
+            "partner_ids": [],
+        }
+        group_ids = {}
+        for group_id, (domain, partner_ids) in enumerate(partners_groups.items()):
+            group_ids[domain] = group_id
+            params["group_ids"] += [group_id] * len(partner_ids)
+            params["partner_ids"] += partner_ids
+        for rule_id, (product_ids, domain) in enumerate(rules):
+            if product_ids is None:
+                params["any_product_rule_ids"].append(rule_id)
+            else:
+                params["rule_ids"] += [rule_id] * len(product_ids)
+                params["product_ids"] += product_ids
+            if domain in group_ids:
+                params["restricted_rule_ids"].append(rule_id)
+                params["rule_group_ids"].append(group_ids[domain])
+        self.env.cr.execute(
+            """
+            WITH rule_product (rule_id, product_id) AS (
+                SELECT *
+                FROM unnest(%(rule_ids)s::integer[], %(product_ids)s::integer[])
+            ), rule_order (rule_id, order_id, partner_id) AS (
+                SELECT rp.rule_id, s.id, s.partner_id
+                FROM rule_product rp
+                JOIN sale_order_line l ON l.product_id = rp.product_id
+                JOIN sale_order s ON s.id = l.order_id
+                WHERE s.state IN ('draft', 'sent')
+                UNION
+                SELECT r.rule_id, s.id, s.partner_id
+                FROM unnest(%(any_product_rule_ids)s::integer[]) AS r(rule_id)
+                CROSS JOIN sale_order s
+                WHERE s.state IN ('draft', 'sent')
+            ), rule_group (rule_id, group_id) AS (
+                SELECT *
+                FROM unnest(
+                    %(restricted_rule_ids)s::integer[], %(rule_group_ids)s::integer[]
+                )
+            ), group_partner (group_id, partner_id) AS (
+                SELECT *
+                FROM unnest(%(group_ids)s::integer[], %(partner_ids)s::integer[])
+            )
+            SELECT s.id
+            FROM sale_order s
+            WHERE s.state IN ('draft', 'sent')
+                AND EXISTS (
+                    SELECT 1 FROM sale_order_line l
+                    WHERE l.order_id = s.id
+                        AND l.product_id = ANY(%(discount_product_ids)s::integer[])
+                )
+            UNION
+            SELECT ro.order_id
+            FROM rule_order ro
+            LEFT JOIN rule_group rg ON rg.rule_id = ro.rule_id
+            WHERE rg.rule_id IS NULL
+                OR EXISTS (
+                    SELECT 1 FROM group_partner gp
+                    WHERE gp.group_id = rg.group_id AND gp.partner_id = ro.partner_id
+                )
+            ORDER BY 1
+            """,
+            params,
+        )
+        return self.env["sale.order"].browse([row[0] for row in self.env.cr.fetchall()])
+
+    @api.model
+    def _get_recompute_partners_groups(self, domains):
+        """Customers of quotations matching every partners domain. Each domain is
+        searched once, restricted to the customers in batches.
+
+        :param domains: set of partners domains strings
+        :return: dict partners domain -> list of partner ids, without the domains
+          matching any partner
+        """
+        domains = {domain: safe_eval(domain) for domain in domains}
+        domains = {key: domain for key, domain in domains.items() if domain}
+        if not domains:
+            return {}
+        self.env.cr.execute(
+            """
+            SELECT DISTINCT partner_id FROM sale_order
+            WHERE state IN ('draft', 'sent')
+            ORDER BY partner_id
+            """
+        )
+        customer_ids = [row[0] for row in self.env.cr.fetchall()]
+        partner_obj = self.env["res.partner"]
+        groups = {}
+        for key, domain in domains.items():
+            groups[key] = []
+            for ids in split_every(RECOMPUTE_PARTNERS_BATCH_SIZE, customer_ids, list):
+                groups[key] += partner_obj.search(domain + [("id", "in", ids)]).ids
+        return groups
+
+    def action_recompute_orders(self):
+        """Recompute in the background the promotions of the quotations affected by
+        the programs"""
+        job = self.env["sale.coupon.recompute.job"]._create_for_orders(
+            self._get_recompute_orders(), self
+        )
+        action = self.env.ref(
+            "sale_coupon_criteria_multi_product.sale_coupon_recompute_job_action"
+        ).read()[0]
+        action.update({"res_id": job.id, "views": [(False, "form")]})
+        return action
+
+    def _simulate_multi_product(
+        self, date_from, date_to, batch_size=SIMULATION_BATCH_SIZE
+    ):
+        """Replay the multi product criterias of the program over the confirmed
+        orders of the given dates, as `_filter_programs_on_products` would have
+        checked them, to know how many would have got the reward. Only the ordered
+        quantities of the criterias products are read, grouped by order and product
+        with SQL, in batches of orders.
+
+        :param date_from: first order date (included)
+        :param date_to: last order date (excluded)
+        :return: dict with the keys:
+          - ``order_count``: number of orders in the dates.
+          - ``qualified_count``: number of orders fulfilling all the criterias.
+          - ``criteria_hits``: dict criteria id -> number of orders fulfilling it.
+          - ``discount_amount``: estimated cost of the rewards in company currency,
+            as computed by `_get_simulated_rewards`.
+        """
+        self.ensure_one()
+        index = self.env["sale.coupon.criteria"]._get_multi_product_index()
+        criteria_ids = set(self._get_rules().criteria_ids)
+        deductions = self._get_multi_product_deductions(index)
+        product_ids = set()
+        for criteria_id in criteria_ids:
+            product_ids |= index["criteria_products"].get(criteria_id, frozenset())
+        self.env["sale.order"].flush(["state", "date_order"])
+        self.env["sale.order.line"].flush(
+            ["order_id", "product_id", "product_uom_qty", "is_reward_line"]
+        )
+        cr = self.env.cr
+        params = {
+            "date_from": date_from,
+            "date_to": date_to,
+            "product_ids": tuple(product_ids) or (None,),
+            "limit": batch_size,
+        }
+        cr.execute(
+            """
+            SELECT COUNT(*) FROM sale_order
+            WHERE state IN ('sale', 'done')
+                AND date_order >= %(date_from)s AND date_order < %(date_to)s
+            """,
+            params,
+        )
+        result = {
+            "order_count": cr.fetchone()[0],
+            "qualified_count": 0,
+            "criteria_hits": dict.fromkeys(criteria_ids, 0),
+            "discount_amount": 0.0,
+        }
+        if not criteria_ids:
+            return result
+        last_id = 0
+        while True:
+            # Only the orders with any of the criterias products can qualify
+            cr.execute(
+                """
+                SELECT DISTINCT l.order_id
+                FROM sale_order_line l
+                JOIN sale_order s ON s.id = l.order_id
+                WHERE s.state IN ('sale', 'done')
+                    AND s.date_order >= %(date_from)s AND s.date_order < %(date_to)s
+                    AND l.product_id IN %(product_ids)s
+                    AND l.order_id > %(last_id)s
+                ORDER BY l.order_id
+                LIMIT %(limit)s
+                """,
+                dict(params, last_id=last_id),
+            )
+            order_ids = [row[0] for row in cr.fetchall()]
+            if not order_ids:
+                break
+            last_id = order_ids[-1]
+            cr.execute(
+                """
+                SELECT order_id, product_id, SUM(product_uom_qty)
+                FROM sale_order_line
+                WHERE order_id IN %(order_ids)s
+                    AND product_id IN %(product_ids)s
+                    AND is_reward_line IS NOT TRUE
+                GROUP BY order_id, product_id
+                """,
+                dict(params, order_ids=tuple(order_ids)),
+            )
+            orders_products_qties = defaultdict(dict)
+            for order_id, product_id, qty in cr.fetchall():
+                orders_products_qties[order_id][product_id] = qty
+            qualified_ids = []
+            for order_id, products_qties in orders_products_qties.items():
+                matched_criterias = (
+                    self._get_matched_multi_product_criterias(
+                        products_qties, index, deductions
+                    )
+                    & criteria_ids
+                )
+                for criteria_id in matched_criterias:
+                    result["criteria_hits"][criteria_id] += 1
+                if matched_criterias == criteria_ids:
+                    qualified_ids.append(order_id)
+            result["qualified_count"] += len(qualified_ids)
+            if qualified_ids:
+                result["discount_amount"] += sum(
+                    self._get_simulated_rewards(qualified_ids).values()
+                )
+        return result
+
+    def _get_simulated_rewards(self, order_ids):
+        """Estimated reward of the program in the given orders, in company currency.
+        Reward products are valued at their sales price and free shippings aren't
+        valued.
+
+        :return: dict order id -> reward amount
+        """
+        self.ensure_one()
+        if self.reward_type == "product":
+            amount = self.reward_product_id.lst_price * self.reward_product_quantity
+            return dict.fromkeys(order_ids, amount)
+        if self.reward_type != "discount":
+            return dict.fromkeys(order_ids, 0.0)
+        self.env["sale.order.line"].flush(
+            ["price_unit", "price_subtotal", "product_uom_qty"]
+        )
+        self.env.cr.execute(
+            """
+            SELECT s.id,
+                SUM(l.price_subtotal) / r.rate,
+                MIN(l.price_unit) FILTER (WHERE l.product_uom_qty > 0) / r.rate,
+                COALESCE(
+                    SUM(l.price_subtotal) FILTER (
+                        WHERE l.product_id IN %(specific_product_ids)s
+                    ),
+                    0
+                ) / r.rate
+            FROM sale_order s
+            CROSS JOIN LATERAL (
+                SELECT CASE COALESCE(s.currency_rate, 0)
+                    WHEN 0 THEN 1.0 ELSE s.currency_rate END AS rate
+            ) r
+            JOIN sale_order_line l ON l.order_id = s.id
+            WHERE s.id IN %(order_ids)s AND l.is_reward_line IS NOT TRUE
+            GROUP BY s.id, r.rate
+            """,
+            {
+                "order_ids": tuple(order_ids),
+                "specific_product_ids": tuple(self.discount_specific_product_ids.ids)
+                or (None,),
+            },
+        )
+        rewards = {}
+        for order_id, amount, cheapest_price, specific_amount in self.env.cr.fetchall():
+            if self.discount_type == "fixed_amount":
+                reward = min(self.discount_fixed_amount, amount)
+            else:
+                base = {
+                    "cheapest_product": cheapest_price or 0.0,
+                    "specific_products": specific_amount,
+                }.get(self.discount_apply_on, amount)
+                reward = base * self.discount_percentage / 100
+                if self.discount_max_amount:
+                    reward = min(reward, self.discount_max_amount)
+            rewards[order_id] = reward
+        return rewards
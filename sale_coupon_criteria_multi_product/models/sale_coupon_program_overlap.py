@@ -0,0 +1,64 @@
+# Copyright 2021 Tecnativa - David Vidal
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import fields, models, tools
+
+
+class SaleCouponProgramOverlap(models.Model):
+    """Pairs of multi product programs sharing criterias with the same fingerprint.
+    Programs with all of them in common are fulfilled by the same orders, though
+    their rewards, partners and dates can still differ."""
+
+    _name = "sale.coupon.program.overlap"
+    _description = "Overlapping Coupon Programs"
+    _auto = False
+    _order = "same_criterias desc, shared_count desc"
+
+    program_id = fields.Many2one(
+        comodel_name="sale.coupon.program", string="Program", readonly=True,
+    )
+    other_program_id = fields.Many2one(
+        comodel_name="sale.coupon.program", string="Overlapping Program", readonly=True,
+    )
+    shared_count = fields.Integer(string="Shared Criterias", readonly=True)
+    criteria_count = fields.Integer(string="Program Criterias", readonly=True)
+    other_criteria_count = fields.Integer(
+        string="Overlapping Program Criterias", readonly=True,
+    )
+    same_criterias = fields.Boolean(string="Same Criterias", readonly=True)
+
+    def init(self):
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute(
+            """
+            CREATE OR REPLACE VIEW %s AS (
+                WITH program_criterias AS (
+                    SELECT DISTINCT c.program_id, c.fingerprint
+                    FROM sale_coupon_criteria c
+                    JOIN sale_coupon_program p ON p.id = c.program_id
+                    WHERE p.active AND p.sale_coupon_criteria = 'multi_product'
+                        AND c.fingerprint IS NOT NULL
+                ), program_counts AS (
+                    SELECT program_id, COUNT(*) AS criteria_count
+                    FROM program_criterias
+                    GROUP BY program_id
+                )
+                SELECT row_number() OVER (ORDER BY a.program_id, b.program_id) AS id,
+                    a.program_id,
+                    b.program_id AS other_program_id,
+                    COUNT(*) AS shared_count,
+                    ca.criteria_count,
+                    cb.criteria_count AS other_criteria_count,
+                    COUNT(*) = ca.criteria_count
+                        AND COUNT(*) = cb.criteria_count AS same_criterias
+                FROM program_criterias a
+                JOIN program_criterias b
+                    ON b.fingerprint = a.fingerprint AND b.program_id > a.program_id
+                JOIN program_counts ca ON ca.program_id = a.program_id
+                JOIN program_counts cb ON cb.program_id = b.program_id
+                GROUP BY a.program_id, b.program_id, ca.criteria_count,
+                    cb.criteria_count
+            )
+            """
+            % self._table
+        )
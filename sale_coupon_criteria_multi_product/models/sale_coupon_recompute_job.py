@@ -0,0 +1,203 @@
+# Copyright 2021 Tecnativa - David Vidal
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import logging
+
+from psycopg2 import OperationalError
+
+from odoo import _, api, fields, models
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+# Orders recomputed in the same transaction
+RECOMPUTE_CHUNK_SIZE = 100
+# Times a chunk is tried again after a concurrent update error
+RECOMPUTE_MAX_TRIES = 5
+
+
+class SaleCouponRecomputeJob(models.Model):
+    """Recompute of the promotions of many quotations. Orders are split in chunks
+    recomputed in their own transaction by the recompute scheduled actions, so
+    every one of them only locks a few orders for a short time. There can be as
+    many chunks in progress at once as active recompute scheduled actions."""
+
+    _name = "sale.coupon.recompute.job"
+    _description = "Coupon Programs Recompute"
+    _order = "id desc"
+
+    name = fields.Char(required=True, readonly=True)
+    program_ids = fields.Many2many(
+        comodel_name="sale.coupon.program", string="Programs", readonly=True,
+    )
+    chunk_ids = fields.One2many(
+        comodel_name="sale.coupon.recompute.chunk",
+        inverse_name="job_id",
+        string="Chunks",
+        readonly=True,
+    )
+    order_count = fields.Integer(string="Orders", readonly=True)
+    done_order_count = fields.Integer(
+        compute="_compute_progress", string="Recomputed Orders"
+    )
+    failed_chunk_count = fields.Integer(
+        compute="_compute_progress", string="Failed Chunks"
+    )
+    progress = fields.Float(compute="_compute_progress")
+    state = fields.Selection(
+        selection=[("pending", "Pending"), ("done", "Done"), ("failed", "Failed")],
+        compute="_compute_progress",
+    )
+
+    @api.depends("chunk_ids.state")
+    def _compute_progress(self):
+        chunks_data = self.env["sale.coupon.recompute.chunk"].read_group(
+            [("job_id", "in", self.ids)],
+            ["job_id", "state", "order_count"],
+            ["job_id", "state"],
+            lazy=False,
+        )
+        mapped_data = {
+            (data["job_id"][0], data["state"]): (data["__count"], data["order_count"])
+            for data in chunks_data
+        }
+        for job in self:
+            done_orders = mapped_data.get((job.id, "done"), (0, 0))[1]
+            failed_chunks = mapped_data.get((job.id, "failed"), (0, 0))[0]
+            job.done_order_count = done_orders
+            job.failed_chunk_count = failed_chunks
+            job.progress = job.order_count and 100.0 * done_orders / job.order_count
+            if (job.id, "pending") in mapped_data:
+                job.state = "pending"
+            else:
+                job.state = "failed" if failed_chunks else "done"
+
+    @api.model
+    def _create_for_orders(
+        self, orders, programs=None, chunk_size=RECOMPUTE_CHUNK_SIZE
+    ):
+        """Split the orders in chunks to be recomputed in the background
+
+        :param programs: programs which changes cause the recompute
+        :return: the new job
+        """
+        programs = programs or self.env["sale.coupon.program"]
+        return self.create(
+            {
+                "name": ", ".join(programs.mapped("name")) or _("Quotations"),
+                "program_ids": [(6, 0, programs.ids)],
+                "order_count": len(orders),
+                "chunk_ids": [
+                    (0, 0, {"order_ids": [(6, 0, order_ids)]})
+                    for order_ids in split_every(chunk_size, orders.ids, list)
+                ],
+            }
+        )
+
+    def action_retry(self):
+        self.mapped("chunk_ids").filtered(lambda x: x.state == "failed").write(
+            {"state": "pending", "tries": 0, "error": False}
+        )
+
+    @api.model
+    def _process_chunks(self, limit=None, commit=False):
+        """Recompute the pending chunks one by one. The chunk being recomputed is
+        locked, so concurrent calls skip it and take the next one.
+
+        :param limit: maximum number of chunks to recompute
+        :param commit: commit every chunk
+        :return: number of processed chunks
+        """
+        chunk_obj = self.env["sale.coupon.recompute.chunk"]
+        processed = 0
+        while limit is None or processed < limit:
+            chunk_obj.flush(["state"])
+            self.env.cr.execute(
+                """
+                SELECT id FROM sale_coupon_recompute_chunk
+                WHERE state = 'pending'
+                ORDER BY tries, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+                """
+            )
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            chunk = chunk_obj.browse(row[0])
+            chunk._recompute()
+            processed += 1
+            job = chunk.job_id
+            _logger.info(
+                "Coupon programs recompute %s: %s/%s orders recomputed",
+                job.id,
+                job.done_order_count,
+                job.order_count,
+            )
+            if commit:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+        return processed
+
+
+class SaleCouponRecomputeChunk(models.Model):
+    _name = "sale.coupon.recompute.chunk"
+    _description = "Coupon Programs Recompute Chunk"
+    _order = "id"
+
+    job_id = fields.Many2one(
+        comodel_name="sale.coupon.recompute.job",
+        required=True,
+        ondelete="cascade",
+        index=True,
+    )
+    order_ids = fields.Many2many(comodel_name="sale.order", string="Orders")
+    order_count = fields.Integer(compute="_compute_order_count", store=True)
+    state = fields.Selection(
+        selection=[("pending", "Pending"), ("done", "Done"), ("failed", "Failed")],
+        default="pending",
+        required=True,
+        index=True,
+    )
+    tries = fields.Integer(default=0)
+    error = fields.Text()
+
+    @api.depends("order_ids")
+    def _compute_order_count(self):
+        for chunk in self:
+            chunk.order_count = len(chunk.order_ids)
+
+    def _recompute(self):
+        """Recompute the promotions of the chunk quotations. Concurrent update errors
+        leave it pending to be tried again in a new transaction, up to
+        RECOMPUTE_MAX_TRIES times."""
+        self.ensure_one()
+        orders = self.order_ids.filtered(lambda x: x.state in ("draft", "sent"))
+        # Nothing from before is discarded with the failed recompute changes
+        self.flush()
+        try:
+            with self.env.cr.savepoint():
+                orders.recompute_coupon_lines()
+                self.flush()
+        except OperationalError as error:
+            if error.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                raise
+            # Drop the pending changes of the failed recompute too, rolled back
+            # with the savepoint, so they aren't written afterwards
+            self.env.clear()
+            tries = self.tries + 1
+            self.write(
+                {
+                    "tries": tries,
+                    "state": "failed" if tries >= RECOMPUTE_MAX_TRIES else "pending",
+                    "error": str(error),
+                }
+            )
+            return
+        except Exception as error:
+            _logger.exception("Coupon programs recompute chunk %s failed", self.id)
+            self.env.clear()
+            self.write(
+                {"tries": self.tries + 1, "state": "failed", "error": str(error)}
+            )
+            return
+        self.write({"state": "done", "error": False})
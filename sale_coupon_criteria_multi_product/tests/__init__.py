@@ -1 +1,2 @@
 from . import test_sale_coupon_criteria_multi_product
+from . import test_sale_coupon_criteria_multi_product_benchmark
@@ -1,6 +1,14 @@
 # Copyright 2021 Tecnativa - David Vidal
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from collections import Counter
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.exceptions import ValidationError
 from odoo.tests import Form, common
+from odoo.tools import mute_logger
+
+from ..models.sale_coupon_criteria import _selectivity_stats
 
 
 class TestSaleCouponCriteriaMultiProduct(common.SavepointCase):
@@ -104,3 +112,407 @@ class TestSaleCouponCriteriaMultiProduct(common.SavepointCase):
         self.sale.recompute_coupon_lines()
         discount_line = self.sale.order_line.filtered("is_reward_line")
         self.assertFalse(discount_line)
+
+    def test_sale_coupon_criteria_multi_product_index(self):
+        """The criterias index is kept up to date with the criterias changes"""
+        criteria_obj = self.env["sale.coupon.criteria"]
+        criterias = self.coupon_program.sale_coupon_criteria_ids
+        criteria_a, criteria_bc, criteria_de = criterias
+        index = criteria_obj._get_multi_product_index()
+        self.assertEqual(
+            index["product_criterias"][self.product_b.id], {criteria_bc.id}
+        )
+        self.assertEqual(index["criterias"][criteria_de.id], (3, True, 2))
+        self.assertNotIn(self.product_f.id, index["product_criterias"])
+        # Only the criterias with ordered products can be fulfilled
+        matched = self.coupon_program._get_matched_multi_product_criterias(
+            {self.product_a.id: 1, self.product_b.id: 1, self.product_e.id: 2}, index
+        )
+        self.assertEqual(matched, {criteria_a.id})
+        # Once written, the index is rebuilt
+        criteria_a.product_ids = self.product_f
+        index = criteria_obj._get_multi_product_index()
+        self.assertEqual(index["product_criterias"][self.product_f.id], {criteria_a.id})
+        self.assertNotIn(self.product_a.id, index["product_criterias"])
+        self.sale.recompute_coupon_lines()
+        self.assertFalse(self.sale.order_line.filtered("is_reward_line"))
+        self.sale.order_line.filtered(
+            lambda x: x.product_id == self.product_a
+        ).product_id = self.product_f
+        self.sale.recompute_coupon_lines()
+        self.assertTrue(self.sale.order_line.filtered("is_reward_line"))
+
+    def test_sale_coupon_criteria_multi_product_orders_batch(self):
+        """Programs are filtered for many orders at once as they're for one"""
+        sale_2 = self.sale.copy()
+        sale_2.order_line.filtered(
+            lambda x: x.product_id == self.product_e
+        ).product_uom_qty = 2
+        sale_3 = self.sale.copy()
+        sale_3.order_line.filtered(
+            lambda x: x.product_id == self.product_b
+        ).product_id = self.product_d
+        domain_program = self.coupon_program.copy({"sale_coupon_criteria": "domain"})
+        programs = self.coupon_program + domain_program
+        orders = self.sale + sale_2 + sale_3
+        valid_programs = programs._filter_programs_on_orders(orders)
+        self.assertEqual(valid_programs[self.sale.id], programs)
+        self.assertEqual(valid_programs[sale_2.id], domain_program)
+        self.assertEqual(valid_programs[sale_3.id], domain_program)
+        for order in orders:
+            self.assertEqual(
+                valid_programs[order.id], programs._filter_programs_on_products(order)
+            )
+
+    def test_sale_coupon_criteria_multi_product_selectivity(self):
+        """Criterias more likely to fail are checked first and the checks results
+        are collected when enabled"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "sale_coupon_criteria_multi_product.selectivity_stats", "1"
+        )
+        (
+            criteria_a,
+            criteria_bc,
+            criteria_de,
+        ) = self.coupon_program.sale_coupon_criteria_ids
+        index = self.env["sale.coupon.criteria"]._get_multi_product_index()
+        # The fewer products and the more quantity the sooner it's checked
+        self.assertEqual(
+            [
+                index["criteria_ranks"][criteria.id]
+                for criteria in (criteria_a, criteria_de, criteria_bc)
+            ],
+            [0, 1, 2],
+        )
+        _selectivity_stats.pop(self.env.cr.dbname)
+        self.coupon_program._filter_programs_on_products(self.sale)
+        self.sale.order_line.filtered(
+            lambda x: x.product_id == self.product_e
+        ).product_uom_qty = 2
+        self.coupon_program._filter_programs_on_products(self.sale)
+        stats = _selectivity_stats.pop(self.env.cr.dbname)
+        # The results kept from the previous check aren't counted
+        self.assertEqual(stats[criteria_a.id, "hit_count"], 1)
+        self.assertEqual(stats[criteria_de.id, "hit_count"], 1)
+        self.assertEqual(stats[criteria_de.id, "miss_count"], 1)
+        self.assertEqual(stats[criteria_bc.id, "hit_count"], 1)
+        self.assertEqual(stats[criteria_bc.id, "skip_count"], 1)
+        # The most failing criterias go first once the stats are there
+        criteria_bc.write({"hit_count": 1, "miss_count": 9})
+        # Collecting stats doesn't invalidate the index by itself
+        self.env["sale.coupon.criteria"].clear_caches()
+        index = self.env["sale.coupon.criteria"]._get_multi_product_index()
+        self.assertEqual(index["criteria_ranks"][criteria_bc.id], 0)
+        self.assertEqual(criteria_bc.miss_rate, 0.9)
+        # Buffered results are added to the stored counters
+        criteria_bc.flush()
+        self.env["sale.coupon.criteria"]._add_selectivity_stats(
+            Counter({(criteria_bc.id, "miss_count"): 3})
+        )
+        _selectivity_stats.flush(self.env.cr)
+        self.assertFalse(_selectivity_stats.pop(self.env.cr.dbname))
+        criteria_bc.invalidate_cache(["miss_count"])
+        self.assertEqual(criteria_bc.miss_count, 12)
+
+    def test_sale_coupon_criteria_multi_product_valid_products(self):
+        """Valid products are worked out from the indexed criteria products"""
+        (
+            criteria_a,
+            criteria_bc,
+            criteria_de,
+        ) = self.coupon_program.sale_coupon_criteria_ids
+        products = self.product_a + self.product_b + self.product_e + self.product_f
+        self.assertEqual(
+            self.coupon_program._get_valid_products_multi_product(products, criteria_a),
+            self.product_a,
+        )
+        self.assertFalse(
+            self.coupon_program._get_valid_products_multi_product(products, criteria_bc)
+        )
+        self.assertEqual(
+            self.coupon_program._get_valid_products_multi_product(
+                products, criteria_de
+            ),
+            self.product_e,
+        )
+        # Not indexed criterias work the same
+        new_criteria = self.env["sale.coupon.criteria"].new(
+            {"product_ids": [(6, 0, (self.product_b + self.product_f).ids)]}
+        )
+        self.assertEqual(
+            self.coupon_program._get_valid_products_multi_product(
+                products, new_criteria
+            ),
+            self.product_b + self.product_f,
+        )
+
+    def test_sale_coupon_criteria_multi_product_incremental(self):
+        """Only the criterias affected by the order changes are checked again"""
+        (
+            criteria_a,
+            criteria_bc,
+            criteria_de,
+        ) = self.coupon_program.sale_coupon_criteria_ids
+        program_class = type(self.coupon_program)
+        with patch.object(
+            program_class,
+            "_check_multi_product_criteria",
+            autospec=True,
+            side_effect=program_class._check_multi_product_criteria,
+        ) as check:
+            self.coupon_program._filter_programs_on_products(self.sale)
+            self.assertEqual(check.call_count, 3)
+            check.reset_mock()
+            # Nothing changed
+            self.assertEqual(
+                self.coupon_program._filter_programs_on_products(self.sale),
+                self.coupon_program,
+            )
+            self.assertFalse(check.called)
+            # Only the criteria with product E is affected
+            self.sale.order_line.filtered(
+                lambda x: x.product_id == self.product_e
+            ).product_uom_qty = 2
+            self.assertFalse(
+                self.coupon_program._filter_programs_on_products(self.sale)
+            )
+            self.assertEqual(check.call_count, 1)
+            self.assertEqual(check.call_args[0][1], criteria_de)
+            check.reset_mock()
+            # Changing a criteria drops the previous results
+            criteria_de.rule_min_quantity = 2
+            self.assertEqual(
+                self.coupon_program._filter_programs_on_products(self.sale),
+                self.coupon_program,
+            )
+            self.assertEqual(check.call_count, 3)
+
+    def test_sale_coupon_criteria_multi_product_rules(self):
+        """Programs rules are compiled once and follow the programs changes"""
+        program_obj = self.env["sale.coupon.program"]
+        rules = program_obj._get_programs_rules()[self.coupon_program.id]
+        self.assertIs(program_obj._get_programs_rules()[self.coupon_program.id], rules)
+        self.assertEqual(rules.sale_coupon_criteria, "multi_product")
+        self.assertEqual(
+            rules.criteria_ids, tuple(self.coupon_program.sale_coupon_criteria_ids.ids)
+        )
+        self.assertFalse(hasattr(rules, "__dict__"))
+        self.coupon_program.sale_coupon_criteria_ids[0].unlink()
+        rules = program_obj._get_programs_rules()[self.coupon_program.id]
+        self.assertEqual(len(rules.criteria_ids), 2)
+        self.coupon_program.active = False
+        self.assertNotIn(self.coupon_program.id, program_obj._get_programs_rules())
+        self.assertEqual(
+            self.coupon_program._get_rules().criteria_ids, rules.criteria_ids
+        )
+
+    def test_sale_coupon_criteria_multi_product_recompute_job(self):
+        """Quotations are recomputed in chunks"""
+        sale_2 = self.sale.copy()
+        job = self.env["sale.coupon.recompute.job"]._create_for_orders(
+            self.sale + sale_2, self.coupon_program, chunk_size=1
+        )
+        self.assertEqual(len(job.chunk_ids), 2)
+        self.assertEqual(job.state, "pending")
+        self.assertEqual(job.progress, 0)
+        job_obj = self.env["sale.coupon.recompute.job"]
+        self.assertEqual(job_obj._process_chunks(limit=1), 1)
+        self.assertEqual(job.done_order_count, 1)
+        job_obj._process_chunks()
+        self.assertEqual(job.state, "done")
+        self.assertEqual(job.progress, 100)
+        self.assertTrue(self.sale.order_line.filtered("is_reward_line"))
+        self.assertTrue(sale_2.order_line.filtered("is_reward_line"))
+
+    def test_sale_coupon_criteria_multi_product_recompute_job_failed(self):
+        """Changes of a failed chunk recompute aren't written afterwards"""
+
+        def recompute_coupon_lines(orders):
+            orders.write({"note": "Failed recompute"})
+            raise ValueError("Failed recompute")
+
+        job = self.env["sale.coupon.recompute.job"]._create_for_orders(self.sale)
+        with patch.object(
+            type(self.sale),
+            "recompute_coupon_lines",
+            autospec=True,
+            side_effect=recompute_coupon_lines,
+        ), mute_logger(
+            "odoo.addons.sale_coupon_criteria_multi_product.models."
+            "sale_coupon_recompute_job"
+        ):
+            self.env["sale.coupon.recompute.job"]._process_chunks()
+        self.assertEqual(job.state, "failed")
+        self.assertEqual(job.chunk_ids.error, "Failed recompute")
+        self.sale.flush()
+        self.sale.invalidate_cache()
+        self.assertNotEqual(self.sale.note, "Failed recompute")
+
+    def test_sale_coupon_criteria_multi_product_recompute_orders(self):
+        """Only the quotations the program could affect are recomputed"""
+        sale_form = Form(self.env["sale.order"])
+        sale_form.partner_id = self.partner
+        with sale_form.order_line.new() as line_form:
+            line_form.product_id = self.product_f
+        sale_f = sale_form.save()
+        sale_f_rewarded = sale_f.copy()
+        sale_f_rewarded.order_line = [
+            (
+                0,
+                0,
+                {
+                    "name": "Discount",
+                    "product_id": self.coupon_program.discount_line_product_id.id,
+                    "product_uom_qty": 1,
+                    "price_unit": -5,
+                    "is_reward_line": True,
+                },
+            )
+        ]
+        orders = self.coupon_program._get_recompute_orders()
+        self.assertIn(self.sale, orders)
+        self.assertIn(sale_f_rewarded, orders)
+        self.assertNotIn(sale_f, orders)
+        # The partners domain restricts them as well
+        self.coupon_program.rule_partners_domain = "[('id', '!=', %s)]" % (
+            self.partner.id
+        )
+        orders = self.coupon_program._get_recompute_orders()
+        self.assertNotIn(self.sale, orders)
+        self.assertIn(sale_f_rewarded, orders)
+
+    def test_sale_coupon_criteria_multi_product_simulation(self):
+        """The program is replayed over the confirmed orders"""
+        (
+            criteria_a,
+            criteria_bc,
+            criteria_de,
+        ) = self.coupon_program.sale_coupon_criteria_ids
+        sale_2 = self.sale.copy()
+        sale_2.order_line.filtered(
+            lambda x: x.product_id == self.product_e
+        ).product_uom_qty = 2
+        (self.sale + sale_2).action_confirm()
+        date_from = fields.Datetime.subtract(self.sale.date_order, days=1)
+        date_to = fields.Datetime.add(self.sale.date_order, days=1)
+        result = self.coupon_program._simulate_multi_product(
+            date_from, date_to, batch_size=1
+        )
+        self.assertGreaterEqual(result["order_count"], 2)
+        self.assertEqual(result["qualified_count"], 1)
+        self.assertEqual(result["criteria_hits"][criteria_a.id], 2)
+        self.assertEqual(result["criteria_hits"][criteria_bc.id], 2)
+        self.assertEqual(result["criteria_hits"][criteria_de.id], 1)
+        # 10% of the untaxed amount of the order
+        self.assertAlmostEqual(
+            result["discount_amount"], self.sale.amount_untaxed / 10, places=2
+        )
+        result = self.coupon_program._simulate_multi_product(date_to, date_to)
+        self.assertEqual(result["qualified_count"], 0)
+
+    def test_sale_coupon_criteria_multi_product_fingerprint(self):
+        """Criterias with the same rules are checked once and their programs are
+        listed as having the same criterias"""
+        other_program = self.coupon_program.copy(
+            {
+                "sale_coupon_criteria_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_ids": [(6, 0, criteria.product_ids.ids)],
+                            "repeat_product": criteria.repeat_product,
+                            "rule_min_quantity": criteria.rule_min_quantity,
+                        },
+                    )
+                    for criteria in self.coupon_program.sale_coupon_criteria_ids
+                ]
+            }
+        )
+        self.assertEqual(
+            set(self.coupon_program.sale_coupon_criteria_ids.mapped("fingerprint")),
+            set(other_program.sale_coupon_criteria_ids.mapped("fingerprint")),
+        )
+        programs = self.coupon_program + other_program
+        program_class = type(self.coupon_program)
+        with patch.object(
+            program_class,
+            "_check_multi_product_criteria",
+            autospec=True,
+            side_effect=program_class._check_multi_product_criteria,
+        ) as check:
+            self.assertEqual(programs._filter_programs_on_products(self.sale), programs)
+            self.assertEqual(check.call_count, 3)
+        self.env["sale.coupon.criteria"].flush()
+        overlap = self.env["sale.coupon.program.overlap"].search(
+            [("program_id", "=", self.coupon_program.id)]
+        )
+        self.assertEqual(overlap.other_program_id, other_program)
+        self.assertEqual(overlap.shared_count, 3)
+        self.assertTrue(overlap.same_criterias)
+        other_program.sale_coupon_criteria_ids[0].write(
+            {"repeat_product": True, "rule_min_quantity": 2}
+        )
+        self.env["sale.coupon.criteria"].flush()
+        overlap = self.env["sale.coupon.program.overlap"].search(
+            [("program_id", "=", self.coupon_program.id)]
+        )
+        self.assertEqual(overlap.shared_count, 2)
+        self.assertFalse(overlap.same_criterias)
+
+    def test_sale_coupon_criteria_multi_product_create_bulk(self):
+        """Criterias created in bulk are the same as the ones created one by one"""
+        criteria_obj = self.env["sale.coupon.criteria"]
+        program = self.coupon_program.copy()
+        ids = criteria_obj.create_bulk(
+            [
+                {"program_id": program.id, "product_ids": self.product_a.ids},
+                {
+                    "program_id": program.id,
+                    "product_ids": (self.product_b + self.product_c).ids,
+                },
+                {
+                    "program_id": program.id,
+                    "product_ids": (self.product_d + self.product_e).ids,
+                    "repeat_product": True,
+                    "rule_min_quantity": 3,
+                },
+            ]
+        )
+        criterias = criteria_obj.browse(ids)
+        self.assertEqual(program.sale_coupon_criteria_ids, criterias)
+        self.assertEqual(criterias.mapped("rule_min_quantity"), [1, 2, 3])
+        self.assertEqual(criterias[1].product_ids, self.product_b + self.product_c)
+        self.assertEqual(
+            criterias.mapped("fingerprint"),
+            self.coupon_program.sale_coupon_criteria_ids.mapped("fingerprint"),
+        )
+        index = criteria_obj._get_multi_product_index()
+        self.assertEqual(
+            index["product_criterias"][self.product_a.id],
+            {self.coupon_program.sale_coupon_criteria_ids[0].id, ids[0]},
+        )
+        self.assertEqual(
+            (self.coupon_program + program)._filter_programs_on_products(self.sale),
+            self.coupon_program + program,
+        )
+        with self.assertRaises(ValidationError):
+            criteria_obj.create_bulk(
+                [
+                    {
+                        "program_id": program.id,
+                        "product_ids": self.product_a.ids,
+                        "rule_min_quantity": 2,
+                    }
+                ]
+            )
+        # Products are only taken as a list of ids, not as x2many commands
+        with self.assertRaises(ValidationError):
+            criteria_obj.create_bulk(
+                [
+                    {
+                        "program_id": program.id,
+                        "product_ids": [(6, 0, self.product_a.ids)],
+                    }
+                ]
+            )
@@ -0,0 +1,221 @@
+# Copyright 2021 Tecnativa - David Vidal
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from odoo.tests import common, tagged
+
+from ..models.sale_coupon_program import _results_cache
+
+_logger = logging.getLogger(__name__)
+
+# Default sizes of the generated data. Every one of them can be overridden with the
+# environment variable SALE_COUPON_BENCHMARK_<SIZE>, i.e.: SALE_COUPON_BENCHMARK_PRODUCTS
+BENCHMARK_SIZES = {
+    "products": 10000,
+    "programs": 1000,
+    "criterias": 5,
+    "criteria_products": 3,
+    "order_lines": 500,
+}
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+OUTPUT_FILE = os.path.join(tempfile.gettempdir(), "sale_coupon_benchmark.json")
+
+
+@tagged("-standard", "sale_coupon_benchmark")
+class TestSaleCouponCriteriaMultiProductBenchmark(common.SavepointCase):
+    """Benchmark of the multi product programs filter on synthetic data. It isn't run
+    with the standard tests, use ``--test-tags sale_coupon_benchmark`` to run it.
+
+    SQL queries and timings of every measure are compared to the baseline for the
+    same data sizes stored in the file set in SALE_COUPON_BENCHMARK_BASELINE
+    (``benchmark_baseline.json`` next to this file by default), when there's one.
+    Queries can't go above the baseline ones multiplied by
+    SALE_COUPON_BENCHMARK_QUERIES_TOLERANCE (1.2 by default), and timings above them
+    multiplied by SALE_COUPON_BENCHMARK_TOLERANCE (1.5 by default).
+
+    The measures are written to the file set in SALE_COUPON_BENCHMARK_OUTPUT
+    (``sale_coupon_benchmark.json`` in the temporary directory by default). Record
+    the baseline running the benchmark on the reference machine and copying that
+    file as the baseline one.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sizes = {
+            size: int(os.environ.get("SALE_COUPON_BENCHMARK_%s" % size.upper(), value))
+            for size, value in BENCHMARK_SIZES.items()
+        }
+        cls.measures = {}
+        # Always the same data for the same sizes
+        rng = random.Random(42)
+        cls.products = cls.env["product.product"].create(
+            [
+                {"name": "Benchmark product %s" % i, "list_price": rng.randint(1, 100)}
+                for i in range(cls.sizes["products"])
+            ]
+        )
+        product_ids = cls.products.ids
+        programs_vals = []
+        for i in range(cls.sizes["programs"]):
+            criterias_vals = []
+            for _j in range(cls.sizes["criterias"]):
+                criteria_vals = {
+                    "product_ids": [
+                        (6, 0, rng.sample(product_ids, cls.sizes["criteria_products"]))
+                    ],
+                    "repeat_product": rng.random() < 0.5,
+                }
+                if criteria_vals["repeat_product"]:
+                    criteria_vals["rule_min_quantity"] = rng.randint(1, 5)
+                criterias_vals.append((0, 0, criteria_vals))
+            programs_vals.append(
+                {
+                    "name": "Benchmark program %s" % i,
+                    "promo_code_usage": "no_code_needed",
+                    "reward_type": "discount",
+                    "discount_type": "percentage",
+                    "discount_percentage": 10,
+                    "sale_coupon_criteria": "multi_product",
+                    "sale_coupon_criteria_ids": criterias_vals,
+                }
+            )
+        cls.programs = cls.env["sale.coupon.program"].create(programs_vals)
+        partner = cls.env["res.partner"].create({"name": "Benchmark customer"})
+        cls.order = cls.env["sale.order"].create(
+            {
+                "partner_id": partner.id,
+                "order_line": [
+                    (
+                        0,
+                        0,
+                        {
+                            "name": product.name,
+                            "product_id": product.id,
+                            "product_uom": product.uom_id.id,
+                            "product_uom_qty": rng.randint(1, 5),
+                            "price_unit": product.list_price,
+                        },
+                    )
+                    for product in cls.products.browse(
+                        rng.sample(product_ids, cls.sizes["order_lines"])
+                    )
+                ],
+            }
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.measures:
+            output_file = os.environ.get("SALE_COUPON_BENCHMARK_OUTPUT", OUTPUT_FILE)
+            output = cls._read_measures(output_file)
+            output.setdefault(cls._get_sizes_key(), {}).update(cls.measures)
+            with open(output_file, "w") as measures_file:
+                json.dump(output, measures_file, indent=2, sort_keys=True)
+            _logger.info("Benchmark measures written to %s", output_file)
+        super().tearDownClass()
+
+    @classmethod
+    def _get_sizes_key(cls):
+        return ",".join("%s=%s" % (size, cls.sizes[size]) for size in sorted(cls.sizes))
+
+    @classmethod
+    def _read_measures(cls, path):
+        """Measures stored in the file by data sizes"""
+        if not os.path.exists(path):
+            return {}
+        with open(path) as measures_file:
+            return json.load(measures_file)
+
+    def _reset_caches(self):
+        """Start every measure from scratch"""
+        self.env["sale.coupon.criteria"].clear_caches()
+        _results_cache.clear()
+        self.env["sale.coupon.program"].invalidate_cache()
+
+    def _measure(self, name, function, *args):
+        """Time the function call, count its queries and check them against the
+        baseline."""
+        cr = self.env.cr
+        queries = cr.sql_log_count
+        start = time.perf_counter()
+        function(*args)
+        duration = time.perf_counter() - start
+        queries = cr.sql_log_count - queries
+        _logger.info(
+            "Benchmark %s (%s): %.4f s, %s queries",
+            name,
+            self._get_sizes_key(),
+            duration,
+            queries,
+        )
+        self.measures[name] = {"duration": duration, "queries": queries}
+        baseline_file = os.environ.get("SALE_COUPON_BENCHMARK_BASELINE", BASELINE_FILE)
+        baseline = (
+            self._read_measures(baseline_file)
+            .get(self._get_sizes_key(), {})
+            .get(name, {})
+        )
+        if "queries" in baseline:
+            tolerance = float(
+                os.environ.get("SALE_COUPON_BENCHMARK_QUERIES_TOLERANCE", 1.2)
+            )
+            self.assertLessEqual(
+                queries, baseline["queries"] * tolerance, "%s queries" % name
+            )
+        if "duration" in baseline:
+            tolerance = float(os.environ.get("SALE_COUPON_BENCHMARK_TOLERANCE", 1.5))
+            self.assertLessEqual(
+                duration, baseline["duration"] * tolerance, "%s duration" % name
+            )
+
+    def test_filter_programs_on_products_cold(self):
+        """Filter with the criterias index to be built"""
+        self._reset_caches()
+        self._measure(
+            "filter_programs_on_products_cold",
+            self.programs._filter_programs_on_products,
+            self.order,
+        )
+
+    def test_filter_programs_on_products_warm(self):
+        """Filter with the criterias index already built"""
+        self._reset_caches()
+        self.env["sale.coupon.criteria"]._get_multi_product_index()
+        self._measure(
+            "filter_programs_on_products_warm",
+            self.programs._filter_programs_on_products,
+            self.order,
+        )
+
+    def test_filter_programs_on_products_incremental(self):
+        """Filter again after changing an order line"""
+        self._reset_caches()
+        self.programs._filter_programs_on_products(self.order)
+        self.order.order_line[0].product_uom_qty += 1
+        self._measure(
+            "filter_programs_on_products_incremental",
+            self.programs._filter_programs_on_products,
+            self.order,
+        )
+
+    def test_get_valid_products_multi_product(self):
+        """Valid products of every criteria"""
+        self._reset_caches()
+        products = self.order.order_line.mapped("product_id")
+        program_criterias = [
+            (program, criteria)
+            for program in self.programs
+            for criteria in program.sale_coupon_criteria_ids
+        ]
+
+        def get_valid_products():
+            for program, criteria in program_criterias:
+                program._get_valid_products_multi_product(products, criteria)
+
+        self._measure("get_valid_products_multi_product", get_valid_products)
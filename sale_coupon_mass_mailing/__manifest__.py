@@ -3,12 +3,18 @@
 
 {
     "name": "Sale Coupon Mas Mailing",
-    "version": "13.0.1.0.0",
+    "version": "13.0.1.1.0",
     "author": "Tecnativa, Odoo Community Association (OCA)",
     "website": "https://github.com/OCA/sale-promotion",
     "license": "AGPL-3",
     "category": "Marketing",
-    "depends": ["sale_coupon", "mass_mailing"],
-    "data": ["views/mailing_mailing_view.xml", "views/sale_coupon_program_view.xml"],
+    "depends": ["sale_coupon_order_line_link", "mass_mailing"],
+    "data": [
+        "security/ir.model.access.csv",
+        "data/ir_cron_data.xml",
+        "data/ir_actions_server_data.xml",
+        "views/mailing_mailing_view.xml",
+        "views/sale_coupon_program_view.xml",
+    ],
     "installable": True,
 }
@@ -1,2 +1,3 @@
 from . import mailing_mailing
+from . import mailing_program_recipient
 from . import sale_coupon_program
@@ -1,7 +1,15 @@
 # Copyright 2021 Tecnativa - Víctor Martínez
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import api, fields, models
+from psycopg2 import sql
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+from odoo.osv import expression
+from odoo.tools.safe_eval import safe_eval
+
+# Partners added at once to the recipients snapshot and sent to at once from it
+PROGRAM_RECIPIENTS_BATCH_SIZE = 10000
 
 
 class MailingMailing(models.Model):
@@ -10,8 +18,221 @@ class MailingMailing(models.Model):
     program_id = fields.Many2one(
         comodel_name="sale.coupon.program", string="Program", ondelete="cascade"
     )
+    program_recipient_count = fields.Integer(
+        string="Program Recipients", readonly=True, copy=False,
+    )
+    program_recipients_date = fields.Datetime(
+        string="Program Recipients Date",
+        readonly=True,
+        copy=False,
+        help="When the program recipients were computed. The mailing is sent to "
+        "them instead of searching the recipients again.",
+    )
+
+    def init(self):
+        """Most mailings aren't linked to programs. The index name is out of the ORM
+        indexes pattern, so it isn't dropped on every update."""
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS mailing_mailing_program_id_partial_idx
+            ON mailing_mailing (program_id)
+            WHERE program_id IS NOT NULL
+            """
+        )
 
     @api.onchange("program_id")
     def onchange_program_id(self):
         if self.program_id:
             self.mailing_domain = self.program_id.rule_partners_domain
+
+    def write(self, vals):
+        if {
+            "program_id",
+            "mailing_domain",
+            "mailing_model_id",
+            "contact_ab_pc",
+            "unique_ab_testing",
+            "campaign_id",
+        } & set(vals):
+            self.filtered("program_recipients_date")._clear_program_recipients()
+        return super().write(vals)
+
+    def _compute_total(self):
+        """Don't search the recipients again when there's a snapshot"""
+        snapshot_mailings = self.filtered("program_recipients_date")
+        for mailing in snapshot_mailings:
+            mailing.total = mailing.program_recipient_count
+        return super(MailingMailing, self - snapshot_mailings)._compute_total()
+
+    def _clear_program_recipients(self):
+        if not self:
+            return
+        self.env.cr.execute(
+            "DELETE FROM mailing_program_recipient WHERE mailing_id IN %s",
+            (tuple(self.ids),),
+        )
+        self.write({"program_recipient_count": 0, "program_recipients_date": False})
+
+    def action_compute_program_recipients(self):
+        for mailing in self:
+            mailing._compute_program_recipients()
+
+    def _compute_program_recipients(self, batch_size=PROGRAM_RECIPIENTS_BATCH_SIZE):
+        """Store the partners eligible for the program and matching the mailing
+        domain, without the blacklisted ones. They're added in batches following
+        the partners ids, so every batch only reads the next rows of the index.
+        With A/B testing only the mailing percentage of them is kept, picked at
+        random, as the standard mailings do.
+        """
+        self.ensure_one()
+        if not self.program_id or self.mailing_model_real != "res.partner":
+            raise UserError(
+                _("Only the program mailings to contacts can compute recipients.")
+            )
+        self._clear_program_recipients()
+        partner_obj = self.env["res.partner"]
+        domain = expression.AND(
+            [
+                safe_eval(self.program_id.rule_partners_domain or "[]"),
+                self._parse_mailing_domain(),
+            ]
+        )
+        partner_obj.flush()
+        self.env["mail.blacklist"].flush(["email", "active"])
+        query = partner_obj._where_calc(domain)
+        partner_obj._apply_ir_rules(query, "read")
+        from_clause, where_clause, where_params = query.get_sql()
+        query = sql.SQL(
+            """
+            WITH batch AS (
+                INSERT INTO mailing_program_recipient (mailing_id, partner_id)
+                SELECT %s, "res_partner".id
+                FROM {from_clause}
+                WHERE ({where_clause})
+                    AND "res_partner".id > %s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM mail_blacklist bl
+                        WHERE bl.active AND bl.email = "res_partner".email_normalized
+                    )
+                ORDER BY "res_partner".id
+                LIMIT %s
+                RETURNING partner_id
+            )
+            SELECT COUNT(*), MAX(partner_id) FROM batch
+            """
+        ).format(
+            from_clause=sql.SQL(from_clause),
+            where_clause=sql.SQL(where_clause or "TRUE"),
+        )
+        total = last_id = 0
+        while True:
+            self.env.cr.execute(
+                query, [self.id] + where_params + [last_id, batch_size],
+            )
+            count, max_id = self.env.cr.fetchone()
+            if not count:
+                break
+            total += count
+            last_id = max_id
+        if self.contact_ab_pc < 100:
+            total = self._pick_program_recipients(
+                int(total / 100.0 * self.contact_ab_pc)
+            )
+        self.write(
+            {
+                "program_recipient_count": total,
+                "program_recipients_date": fields.Datetime.now(),
+            }
+        )
+
+    def _pick_program_recipients(self, limit):
+        """Keep a random sample of the snapshot for A/B testing. With unique A/B
+        testing the partners already mailed by the campaign aren't picked.
+
+        :return: number of recipients kept
+        """
+        self.ensure_one()
+        campaign_id = self.unique_ab_testing and self.campaign_id.id or None
+        self.env["mailing.trace"].flush(["model", "res_id", "mass_mailing_id"])
+        self.env.cr.execute(
+            """
+            WITH picked AS (
+                SELECT r.partner_id
+                FROM mailing_program_recipient r
+                WHERE r.mailing_id = %(mailing_id)s
+                    AND NOT EXISTS (
+                        SELECT 1
+                        FROM mailing_trace t
+                        JOIN mailing_mailing m ON m.id = t.mass_mailing_id
+                        WHERE m.campaign_id = %(campaign_id)s
+                            AND t.model = 'res.partner'
+                            AND t.res_id = r.partner_id
+                    )
+                ORDER BY random()
+                LIMIT %(limit)s
+            )
+            DELETE FROM mailing_program_recipient r
+            WHERE r.mailing_id = %(mailing_id)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM picked p WHERE p.partner_id = r.partner_id
+                )
+            """,
+            {"mailing_id": self.id, "campaign_id": campaign_id, "limit": limit},
+        )
+        self.env.cr.execute(
+            "SELECT COUNT(*) FROM mailing_program_recipient WHERE mailing_id = %s",
+            (self.id,),
+        )
+        return self.env.cr.fetchone()[0]
+
+    def _get_program_recipient_chunks(self, size=PROGRAM_RECIPIENTS_BATCH_SIZE):
+        """Yield the ids of the snapshot partners not mailed yet, in chunks. The
+        next chunk is read once the previous one has been consumed."""
+        self.ensure_one()
+        last_id = 0
+        while True:
+            self.env["mailing.trace"].flush(["model", "res_id", "mass_mailing_id"])
+            self.env.cr.execute(
+                """
+                SELECT r.partner_id
+                FROM mailing_program_recipient r
+                WHERE r.mailing_id = %(mailing_id)s
+                    AND r.partner_id > %(last_id)s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM mailing_trace t
+                        WHERE t.mass_mailing_id = %(mailing_id)s
+                            AND t.model = 'res.partner'
+                            AND t.res_id = r.partner_id
+                    )
+                ORDER BY r.partner_id
+                LIMIT %(size)s
+                """,
+                {"mailing_id": self.id, "last_id": last_id, "size": size},
+            )
+            partner_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not partner_ids:
+                return
+            yield partner_ids
+            last_id = partner_ids[-1]
+
+    def _get_remaining_recipients(self):
+        """With a snapshot only the next chunk of recipients is read, so the whole
+        snapshot is never loaded at once. `action_send_mail` sends the snapshot
+        chunk by chunk, the queue only needs to know whether there's any left."""
+        if not self.program_recipients_date:
+            return super()._get_remaining_recipients()
+        return next(self._get_program_recipient_chunks(), [])
+
+    def action_send_mail(self, res_ids=None):
+        """Send the mailings with recipients snapshot chunk by chunk"""
+        snapshot_mailings = self.filtered("program_recipients_date")
+        if res_ids or not snapshot_mailings:
+            return super().action_send_mail(res_ids=res_ids)
+        for mailing in snapshot_mailings:
+            sent = False
+            for partner_ids in mailing._get_program_recipient_chunks():
+                super(MailingMailing, mailing).action_send_mail(res_ids=partner_ids)
+                sent = True
+            if not sent:
+                raise UserError(_("There are no recipients selected."))
+        return super(MailingMailing, self - snapshot_mailings).action_send_mail()
@@ -0,0 +1,29 @@
+# Copyright 2021 Tecnativa - Víctor Martínez
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import fields, models
+
+
+class MailingProgramRecipient(models.Model):
+    """Snapshot of the partners a program mailing is sent to. It's filled and read
+    with plain SQL, so it's kept as small as possible."""
+
+    _name = "mailing.program.recipient"
+    _description = "Program Mailing Recipient"
+    _log_access = False
+
+    mailing_id = fields.Many2one(
+        comodel_name="mailing.mailing", required=True, ondelete="cascade"
+    )
+    partner_id = fields.Many2one(
+        comodel_name="res.partner", required=True, ondelete="cascade"
+    )
+
+    def init(self):
+        """Recipients are read by mailing in partner order"""
+        self.env.cr.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS mailing_program_recipient_unique_index
+            ON mailing_program_recipient (mailing_id, partner_id)
+            """
+        )
@@ -1,7 +1,15 @@
 # Copyright 2021 Tecnativa - Víctor Martínez
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from psycopg2 import sql
 
 from odoo import api, fields, models
+from odoo.tools import split_every
+
+from odoo.addons.sale_coupon_order_line_link.utils import get_changes_watermark
+from odoo.addons.sale_coupon_profiling.profiler import profiled
+
+# Programs which mailings stats are refreshed at once
+MAILING_STATS_BATCH_SIZE = 1000
 
 
 class SaleCouponProgram(models.Model):
@@ -16,8 +24,25 @@ class SaleCouponProgram(models.Model):
     mailing_count = fields.Integer(
         compute="_compute_mailing_count", string="Mailing count"
     )
+    mailing_sent_count = fields.Integer(string="Mails Sent", readonly=True, copy=False)
+    mailing_opened_count = fields.Integer(
+        string="Mails Opened", readonly=True, copy=False
+    )
+    mailing_clicked_count = fields.Integer(
+        string="Mails Clicked", readonly=True, copy=False
+    )
+    mailing_order_count = fields.Integer(
+        string="Orders from Mailings",
+        readonly=True,
+        copy=False,
+        help="Confirmed orders using the program from mailed contacts",
+    )
 
     @api.depends("mailing_ids")
+    @profiled(
+        programs=lambda self, result: self,
+        records=lambda self, result: self.mailing_ids,
+    )
     def _compute_mailing_count(self):
         mailing_data = self.env["mailing.mailing"].read_group(
             [("program_id", "in", self.ids)], ["program_id"], ["program_id"]
@@ -26,18 +51,22 @@ class SaleCouponProgram(models.Model):
         for program in self:
             program.mailing_count = mapped_data.get(program.id, 0)
 
+    def _prepare_mailing_vals(self, mailing_model):
+        self.ensure_one()
+        return {
+            "program_id": self.id,
+            "mailing_model_id": mailing_model.id,
+            "subject": self.name,
+            "mailing_domain": self.rule_partners_domain,
+        }
+
     def action_mailing_count(self):
         self.ensure_one()
         action = self.env.ref("mass_mailing.mailing_mailing_action_mail")
-        model = self.env["ir.model"].search([("model", "=", "res.partner")])
+        model = self.env["ir.model"]._get("res.partner")
         if not self.mailing_count:
             mailing = self.env["mailing.mailing"].create(
-                {
-                    "program_id": self.id,
-                    "mailing_model_id": model.id,
-                    "subject": self.name,
-                    "mailing_domain": self.rule_partners_domain,
-                }
+                self._prepare_mailing_vals(model)
             )
             result = action.read()[0]
             result["res_id"] = mailing.id
@@ -54,3 +83,140 @@ class SaleCouponProgram(models.Model):
         if self.rule_partners_domain:
             result["context"]["default_mailing_domain"] = self.rule_partners_domain
         return result
+
+    def action_create_mailings(self):
+        """Create at once a mailing for every program without one and list the
+        mailings of all of them"""
+        model = self.env["ir.model"]._get("res.partner")
+        self.env["mailing.mailing"].create(
+            [
+                program._prepare_mailing_vals(model)
+                for program in self.filtered(lambda x: not x.mailing_ids)
+            ]
+        )
+        result = self.env.ref("mass_mailing.mailing_mailing_action_mail").read()[0]
+        result["domain"] = [("program_id", "in", self.ids)]
+        result["context"] = dict(self.env.context, default_mailing_model_id=model.id)
+        return result
+
+    def action_queue_mailings(self):
+        """Queue the draft mailings of the programs ready to be sent, so they're
+        sent in the background by the mass mailing scheduled action instead of
+        blocking the user."""
+        mailings = self.mapped("mailing_ids").filtered(
+            lambda x: x.state == "draft" and x.body_html
+        )
+        mailings.action_put_in_queue()
+        return mailings
+
+    @api.model
+    def _get_outdated_mailing_stats_program_ids(self, since):
+        """Programs with mails or orders using them changed since the given date"""
+        self.env["mailing.trace"].flush(["mass_mailing_id", "write_date"])
+        self.env.cr.execute(
+            """
+            SELECT DISTINCT m.program_id
+            FROM mailing_trace t
+            JOIN mailing_mailing m ON m.id = t.mass_mailing_id
+            WHERE m.program_id IS NOT NULL AND t.write_date >= %s
+            """,
+            (since,),
+        )
+        program_ids = {row[0] for row in self.env.cr.fetchall()}
+        self.env["sale.order"].flush(["write_date"])
+        self.env.cr.execute(
+            """
+            SELECT DISTINCT l.coupon_program_id
+            FROM sale_order_line l
+            JOIN sale_order s ON s.id = l.order_id
+            WHERE l.coupon_program_id IS NOT NULL AND s.write_date >= %s
+            """,
+            (since,),
+        )
+        program_ids.update(row[0] for row in self.env.cr.fetchall())
+        return list(program_ids)
+
+    def _get_mailing_stats_query(self):
+        """Mails and orders stats of the programs in %(program_ids)s, grouped by
+        program in a single query. Orders are counted through the programs linked
+        to their reward lines, and only when their customer had been mailed before
+        ordering."""
+        return """
+            WITH mails AS (
+                SELECT m.program_id,
+                    COUNT(t.sent) AS sent,
+                    COUNT(t.opened) AS opened,
+                    COUNT(t.clicked) AS clicked
+                FROM mailing_mailing m
+                JOIN mailing_trace t ON t.mass_mailing_id = m.id
+                WHERE m.program_id IN %(program_ids)s
+                GROUP BY m.program_id
+            ), orders AS (
+                SELECT l.coupon_program_id AS program_id,
+                    COUNT(DISTINCT s.id) AS orders
+                FROM sale_order_line l
+                JOIN sale_order s ON s.id = l.order_id
+                WHERE l.coupon_program_id IN %(program_ids)s
+                    AND s.state IN ('sale', 'done')
+                    AND EXISTS (
+                        SELECT 1 FROM mailing_trace t
+                        JOIN mailing_mailing m ON m.id = t.mass_mailing_id
+                        WHERE m.program_id = l.coupon_program_id
+                            AND t.model = 'res.partner'
+                            AND t.res_id = s.partner_id
+                            AND t.sent <= s.date_order
+                    )
+                GROUP BY l.coupon_program_id
+            )
+            SELECT p.id, COALESCE(mails.sent, 0), COALESCE(mails.opened, 0),
+                COALESCE(mails.clicked, 0), COALESCE(orders.orders, 0)
+            FROM sale_coupon_program p
+            LEFT JOIN mails ON mails.program_id = p.id
+            LEFT JOIN orders ON orders.program_id = p.id
+            WHERE p.id IN %(program_ids)s
+        """
+
+    @api.model
+    def _refresh_mailing_stats(self, program_ids=None):
+        """Update the mailings stats of the given programs, or of the ones with mails
+        or orders changed since the previous refresh without them.
+
+        :param program_ids: list of coupon program ids
+        """
+        param_obj = self.env["ir.config_parameter"].sudo()
+        param = "sale_coupon_mass_mailing.mailing_stats_date"
+        if program_ids is None:
+            refresh_date = fields.Datetime.to_string(get_changes_watermark(self.env.cr))
+            since = param_obj.get_param(param)
+            program_ids = (
+                self._get_outdated_mailing_stats_program_ids(since)
+                if since
+                else self.with_context(active_test=False).search([]).ids
+            )
+            param_obj.set_param(param, refresh_date)
+        self.env["mailing.trace"].flush()
+        self.env["mailing.mailing"].flush(["program_id"])
+        self.env["sale.order.line"].flush()
+        self.env["sale.order"].flush(["state", "partner_id", "date_order"])
+        query = sql.SQL(
+            """
+            UPDATE sale_coupon_program p
+            SET mailing_sent_count = stats.sent,
+                mailing_opened_count = stats.opened,
+                mailing_clicked_count = stats.clicked,
+                mailing_order_count = stats.orders
+            FROM ({query}) AS stats(id, sent, opened, clicked, orders)
+            WHERE p.id = stats.id
+            """
+        ).format(query=sql.SQL(self._get_mailing_stats_query()))
+        for batch_ids in split_every(MAILING_STATS_BATCH_SIZE, program_ids, tuple):
+            self.env.cr.execute(query, {"program_ids": batch_ids})
+        self.invalidate_cache(
+            [
+                "mailing_sent_count",
+                "mailing_opened_count",
+                "mailing_clicked_count",
+                "mailing_order_count",
+            ],
+            program_ids,
+        )
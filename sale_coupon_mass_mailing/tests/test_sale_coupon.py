@@ -59,3 +59,76 @@ class TestSaleCoupon(common.SavepointCase):
             action["context"]["default_subject"], self.program_custom_partners.name
         )
         self.assertEqual(self.program_custom_partners.mailing_count, 1)
+
+    def test_program_recipients(self):
+        blacklisted = self.env["res.partner"].create(
+            {"name": "Test Partner 3", "email": "blacklisted@example.com"}
+        )
+        self.env["mail.blacklist"].create({"email": "blacklisted@example.com"})
+        self.partner_1.email = "partner1@example.com"
+        self.program_custom_partners.rule_partners_domain = [
+            ("id", "in", (self.partner_1 + self.partner_2 + blacklisted).ids)
+        ]
+        self.program_custom_partners.action_mailing_count()
+        mailing = self.program_custom_partners.mailing_ids
+        mailing.mailing_domain = [("email", "!=", False)]
+        mailing._compute_program_recipients(batch_size=1)
+        self.assertEqual(mailing.program_recipient_count, 1)
+        self.assertEqual(mailing.total, 1)
+        self.assertEqual(
+            list(mailing._get_program_recipient_chunks()), [self.partner_1.ids]
+        )
+        self.assertEqual(mailing._get_remaining_recipients(), self.partner_1.ids)
+        # The snapshot is outdated when the domain changes
+        mailing.mailing_domain = "[]"
+        self.assertFalse(mailing.program_recipients_date)
+        self.assertFalse(mailing.program_recipient_count)
+        # Only the A/B testing percentage of the recipients is kept
+        self.partner_2.email = "partner2@example.com"
+        mailing.contact_ab_pc = 50
+        mailing._compute_program_recipients()
+        self.assertEqual(mailing.program_recipient_count, 1)
+        self.assertIn(
+            mailing._get_remaining_recipients(),
+            [self.partner_1.ids, self.partner_2.ids],
+        )
+
+    def test_program_mailing_stats(self):
+        self.program_custom_partners.action_mailing_count()
+        mailing = self.program_custom_partners.mailing_ids
+        self.env["mailing.trace"].create(
+            [
+                {
+                    "mass_mailing_id": mailing.id,
+                    "model": "res.partner",
+                    "res_id": partner.id,
+                    "sent": "2021-01-01 00:00:00",
+                    "opened": opened,
+                }
+                for partner, opened in (
+                    (self.partner_1, "2021-01-02 00:00:00"),
+                    (self.partner_2, False),
+                )
+            ]
+        )
+        programs = self.program_all_partners + self.program_custom_partners
+        programs._refresh_mailing_stats(programs.ids)
+        self.assertEqual(self.program_custom_partners.mailing_sent_count, 2)
+        self.assertEqual(self.program_custom_partners.mailing_opened_count, 1)
+        self.assertEqual(self.program_custom_partners.mailing_clicked_count, 0)
+        self.assertEqual(self.program_all_partners.mailing_sent_count, 0)
+
+    def test_create_mailings(self):
+        programs = self.program_all_partners + self.program_custom_partners
+        self.program_custom_partners.action_mailing_count()
+        action = programs.action_create_mailings()
+        self.assertEqual(programs.mapped("mailing_count"), [1, 1])
+        self.assertEqual(action["domain"], [("program_id", "in", programs.ids)])
+        self.assertEqual(
+            self.program_all_partners.mailing_ids.subject,
+            self.program_all_partners.name,
+        )
+        programs.mapped("mailing_ids").write({"body_html": "<p>Promotion</p>"})
+        mailings = programs.action_queue_mailings()
+        self.assertEqual(mailings, programs.mapped("mailing_ids"))
+        self.assertEqual(set(mailings.mapped("state")), {"in_queue"})
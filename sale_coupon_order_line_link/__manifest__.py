@@ -4,13 +4,18 @@
     "name": "Link coupons to order lines",
     "summary": "Adds a link between coupons and their generated order lines for easing "
     "tracking",
-    "version": "13.0.1.0.0",
+    "version": "13.0.1.1.0",
     "development_status": "Production/Stable",
     "category": "Sale",
     "website": "https://github.com/OCA/sale-promotion",
     "author": "Tecnativa, Odoo Community Association (OCA)",
     "maintainers": ["chienandalu"],
     "license": "AGPL-3",
-    "depends": ["sale_coupon"],
-    "data": ["reports/sale_report_views.xml"],
+    "depends": ["sale_coupon_profiling"],
+    "data": [
+        "security/ir.model.access.csv",
+        "data/ir_cron_data.xml",
+        "reports/sale_report_views.xml",
+        "reports/sale_coupon_program_report_views.xml",
+    ],
 }
@@ -0,0 +1,52 @@
+# Copyright 2021 Tecnativa - David Vidal
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import logging
+
+from psycopg2 import sql
+
+from odoo.sql_db import db_connect
+
+_logger = logging.getLogger(__name__)
+
+INDEX_NAME = "sale_order_line_coupon_program_id_partial_idx"
+
+
+def migrate(cr, version):
+    """Build the program index of the order lines concurrently, so big databases
+    can keep selling during the upgrade. It's done before the module is loaded, as
+    its `init` would build it locking the table otherwise."""
+    cr.execute(
+        """
+        SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+        """,
+        (INDEX_NAME,),
+    )
+    row = cr.fetchone()
+    if row and row[0]:
+        return
+    # A concurrent build can't run inside a transaction, so it's done with another
+    # cursor in autocommit mode. It waits for every transaction older than itself,
+    # the upgrade one included, so the upgrade transaction has to be finished
+    # first. Nothing has been changed by this module yet at this point.
+    cr.commit()  # pylint: disable=invalid-commit
+    index = sql.Identifier(INDEX_NAME)
+    with db_connect(cr.dbname).cursor() as index_cr:
+        index_cr.autocommit(True)
+        if row:
+            # Left invalid by a previous failed build
+            index_cr.execute(
+                sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(index)
+            )
+        _logger.info("Creating index %s concurrently", INDEX_NAME)
+        index_cr.execute(
+            sql.SQL(
+                """
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {}
+                ON sale_order_line (coupon_program_id)
+                WHERE coupon_program_id IS NOT NULL
+                """
+            ).format(index)
+        )
@@ -1,25 +1,39 @@
 # Copyright 2021 Tecnativa - David Vidal
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
-from odoo import fields, models
+import logging
+
+from odoo import api, fields, models
+
+from odoo.addons.sale_coupon_profiling.profiler import profiled
+
+_logger = logging.getLogger(__name__)
 
 
 class SaleOrder(models.Model):
     _inherit = "sale.order"
 
+    @profiled(
+        programs=lambda self, program, result: program,
+        records=lambda self, program, result: self.order_line,
+    )
     def _get_reward_values_product(self, program):
         """Add the link to the program in the discount line"""
         res = super()._get_reward_values_product(program)
         res["coupon_program_id"] = program.id
         return res
 
+    @profiled(
+        programs=lambda self, program, result: program,
+        records=lambda self, program, result: self.order_line,
+    )
     def _get_reward_values_discount(self, program):
-        """Add the link to the program in the discount line"""
+        """Add the link to the program in the discount lines"""
         res = super()._get_reward_values_discount(program)
-        # The original method returns a dict.values(), which is weird:
-        # https://git.io/J88As
-        vals = [r for r in res][0]
-        vals["coupon_program_id"] = program.id
-        return {"x": vals}.values()
+        # There's a discount line for every tax, which upstream returns as a list
+        # or as a dict.values(), so they're tagged in place
+        for vals in res:
+            vals["coupon_program_id"] = program.id
+        return res
 
 
 class SaleOrderLine(models.Model):
@@ -30,3 +44,112 @@ class SaleOrderLine(models.Model):
         ondelete="restrict",
         string="Coupon Program",
     )
+
+    def init(self):
+        """Only reward lines have a program, so a partial index is enough to find
+        the lines of a program. The migration scripts build it without locking the
+        table on existing databases. Its name is out of the ORM indexes pattern, so
+        it isn't dropped on every update as the field isn't indexed."""
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS sale_order_line_coupon_program_id_partial_idx
+            ON sale_order_line (coupon_program_id)
+            WHERE coupon_program_id IS NOT NULL
+            """
+        )
+
+    @api.model
+    def _backfill_coupon_program_id(self, batch_size=10000, commit=False):
+        """Link the reward lines created before installing this module to their
+        programs: the one with the line product as discount product among the
+        programs and coupons applied on the order. Lines are processed in batches
+        by id, and the last processed id is kept so the job can be resumed after
+        an interruption when the batches are committed. It's kept in the
+        ``sale_coupon_order_line_link.backfill_last_id`` system parameter, but read
+        and written with plain SQL, as writing it through the ORM would clear the
+        registry cache of every worker on every batch.
+
+        :param batch_size: number of lines updated at once
+        :param commit: commit every batch
+        :return: number of linked lines
+        """
+        param_obj = self.env["ir.config_parameter"].sudo()
+        param = "sale_coupon_order_line_link.backfill_last_id"
+        param_obj.flush(["key", "value"])
+        self.env.cr.execute(
+            "SELECT value FROM ir_config_parameter WHERE key = %s", (param,)
+        )
+        row = self.env.cr.fetchone()
+        if not row:
+            # Only the first time
+            param_obj.set_param(param, 0)
+            param_obj.flush(["key", "value"])
+        last_id = int(row and row[0] or 0)
+        self.flush(["is_reward_line", "coupon_program_id", "product_id"])
+        self.env.cr.execute(
+            """
+            SELECT COUNT(*) FROM sale_order_line
+            WHERE is_reward_line AND coupon_program_id IS NULL AND id > %s
+            """,
+            (last_id,),
+        )
+        total = self.env.cr.fetchone()[0]
+        processed = linked = 0
+        while True:
+            # Written in the same statement as the lines to keep them in sync
+            self.env.cr.execute(
+                """
+                WITH batch AS (
+                    SELECT id, order_id, product_id FROM sale_order_line
+                    WHERE is_reward_line AND coupon_program_id IS NULL AND id > %(id)s
+                    ORDER BY id
+                    LIMIT %(limit)s
+                ), updated AS (
+                    UPDATE sale_order_line l
+                    SET coupon_program_id = p.id,
+                        write_date = now() AT TIME ZONE 'UTC'
+                    FROM batch b
+                    JOIN sale_order s ON s.id = b.order_id
+                    JOIN sale_coupon_program p
+                        ON p.discount_line_product_id = b.product_id
+                    WHERE l.id = b.id
+                        AND (
+                            p.id = s.code_promo_program_id
+                            OR EXISTS (
+                                SELECT 1 FROM sale_coupon_program_sale_order_rel r
+                                WHERE r.sale_order_id = s.id
+                                    AND r.sale_coupon_program_id = p.id
+                            )
+                            OR EXISTS (
+                                SELECT 1 FROM sale_coupon c
+                                WHERE c.sales_order_id = s.id AND c.program_id = p.id
+                            )
+                        )
+                    RETURNING l.id
+                )
+                SELECT (SELECT COUNT(*) FROM batch), (SELECT MAX(id) FROM batch),
+                    (SELECT COUNT(*) FROM updated)
+                """,
+                {"id": last_id, "limit": batch_size},
+            )
+            batch_count, batch_last_id, batch_linked = self.env.cr.fetchone()
+            if not batch_count:
+                break
+            processed += batch_count
+            linked += batch_linked
+            last_id = batch_last_id
+            self.env.cr.execute(
+                "UPDATE ir_config_parameter SET value = %s WHERE key = %s",
+                (str(last_id), param),
+            )
+            if commit:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+            _logger.info(
+                "Coupon programs backfill: %s/%s reward lines processed, %s linked",
+                processed,
+                total,
+                linked,
+            )
+        self.invalidate_cache(["coupon_program_id"])
+        param_obj.invalidate_cache(["value"])
+        return linked
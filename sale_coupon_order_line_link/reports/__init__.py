@@ -1 +1,2 @@
 from . import sale_report
+from . import sale_coupon_program_report
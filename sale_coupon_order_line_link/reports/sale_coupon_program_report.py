@@ -0,0 +1,241 @@
+# Copyright 2021 Tecnativa - David Vidal
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from psycopg2 import sql
+
+from odoo import api, fields, models
+
+from ..utils import get_changes_watermark
+
+
+class SaleCouponProgramReport(models.Model):
+    """Promotions performance aggregated from the confirmed order lines. Unlike
+    `sale.report`, it's a regular table refreshed from time to time, so the
+    dashboards don't have to scan the order lines every time."""
+
+    _name = "sale.coupon.program.report"
+    _description = "Coupon Programs Analysis"
+    _order = "date desc"
+    _rec_name = "coupon_program_id"
+
+    coupon_program_id = fields.Many2one(
+        comodel_name="sale.coupon.program",
+        string="Coupon Program",
+        readonly=True,
+        index=True,
+        ondelete="cascade",
+    )
+    company_id = fields.Many2one(comodel_name="res.company", readonly=True)
+    date = fields.Date(string="Order Date", readonly=True)
+    order_count = fields.Integer(string="# of Orders", readonly=True)
+    discount_amount = fields.Float(
+        readonly=True, help="Untaxed amount of the reward lines, in company currency",
+    )
+    reward_quantity = fields.Float(readonly=True)
+    revenue = fields.Float(
+        readonly=True,
+        help="Untaxed amount of the orders with rewards, in company currency",
+    )
+
+    def _query(self, fields=None, groupby="", from_clause=""):
+        """Aggregates of the confirmed orders by program, company and day. Extra
+        dimensions are added like in `sale.report`, but with the fields given as a
+        dict column -> SQL expression. The query takes the programs to aggregate,
+        and when ``by_keys`` is set only their given companies and days.
+
+        :return: tuple (list of columns, query)
+        """
+        currency_rate = (
+            "CASE COALESCE(s.currency_rate, 0) WHEN 0 THEN 1.0 "
+            "ELSE s.currency_rate END"
+        )
+        select_ = {
+            "coupon_program_id": "po.coupon_program_id",
+            "company_id": "s.company_id",
+            "date": "s.date_order::date",
+            "order_count": "COUNT(*)",
+            "discount_amount": "SUM(po.discount_amount)",
+            "reward_quantity": "SUM(po.reward_quantity)",
+            "revenue": "SUM(s.amount_untaxed / %s)" % currency_rate,
+        }
+        select_.update(fields or {})
+        from_ = """
+            (
+                SELECT l.coupon_program_id, l.order_id,
+                    -SUM(l.price_subtotal / %s) AS discount_amount,
+                    SUM(l.product_uom_qty) AS reward_quantity
+                FROM sale_order_line l
+                JOIN sale_order s ON s.id = l.order_id
+                WHERE l.coupon_program_id IS NOT NULL
+                    AND l.is_reward_line
+                    AND s.state IN ('sale', 'done')
+                    AND l.coupon_program_id IN %%(program_ids)s
+                    AND (
+                        NOT %%(by_keys)s
+                        OR (l.coupon_program_id, s.company_id, s.date_order::date)
+                        IN (
+                            SELECT * FROM unnest(
+                                %%(key_program_ids)s::integer[],
+                                %%(key_company_ids)s::integer[],
+                                %%(key_dates)s::date[]
+                            )
+                        )
+                    )
+                GROUP BY l.coupon_program_id, l.order_id
+            ) po
+            JOIN sale_order s ON s.id = po.order_id
+            %s
+        """ % (
+            currency_rate,
+            from_clause,
+        )
+        groupby_ = "po.coupon_program_id, s.company_id, s.date_order::date %s" % (
+            groupby
+        )
+        query = "SELECT %s FROM %s GROUP BY %s" % (
+            ", ".join(select_.values()),
+            from_,
+            groupby_,
+        )
+        return list(select_), query
+
+    @api.model
+    def _get_outdated_keys(self, since):
+        """Rows to recompute, as (program id, company id, date), for the changes
+        since the given date: those of the reward lines in the orders changed since
+        then, and the existing ones of the programs changed since then, as their
+        partner could have changed, and on the days of the changed orders, as their
+        reward lines could have been removed.
+
+        :return: list of tuples (program id, company id, date)
+        """
+        self.flush(["coupon_program_id", "company_id", "date"])
+        self.env["sale.order.line"].flush(["coupon_program_id", "write_date"])
+        self.env["sale.order"].flush(["write_date", "company_id", "date_order"])
+        self.env["sale.coupon.program"].flush(["write_date"])
+        self.env.cr.execute(
+            """
+            WITH changed_order AS (
+                SELECT id, company_id, date_order::date AS date
+                FROM sale_order
+                WHERE write_date >= %(since)s
+            )
+            SELECT l.coupon_program_id, s.company_id, s.date_order::date
+            FROM sale_order_line l
+            JOIN sale_order s ON s.id = l.order_id
+            WHERE l.coupon_program_id IS NOT NULL
+                AND (
+                    l.write_date >= %(since)s
+                    OR l.order_id IN (SELECT id FROM changed_order)
+                )
+            UNION
+            SELECT r.coupon_program_id, r.company_id, r.date
+            FROM sale_coupon_program_report r
+            JOIN sale_coupon_program p ON p.id = r.coupon_program_id
+            WHERE p.write_date >= %(since)s
+            UNION
+            SELECT r.coupon_program_id, r.company_id, r.date
+            FROM sale_coupon_program_report r
+            JOIN (SELECT DISTINCT company_id, date FROM changed_order) d
+                ON d.company_id = r.company_id AND d.date = r.date
+            """,
+            {"since": since},
+        )
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _refresh(self, program_ids=None):
+        """Recompute all the rows of the given programs, or the rows affected by the
+        changes since the previous refresh without them, or all of them on the first
+        one.
+
+        :param program_ids: list of coupon program ids
+        """
+        param_obj = self.env["ir.config_parameter"].sudo()
+        param = "sale_coupon_order_line_link.program_report_date"
+        keys = []
+        if program_ids is None:
+            refresh_date = get_changes_watermark(self.env.cr)
+            since = param_obj.get_param(param)
+            if since:
+                keys = self._get_outdated_keys(since)
+                program_ids = list({key[0] for key in keys})
+            else:
+                program_ids = self._get_all_program_ids()
+            param_obj.set_param(param, fields.Datetime.to_string(refresh_date))
+        if not program_ids:
+            return
+        self.env["sale.order.line"].flush(
+            [
+                "coupon_program_id",
+                "is_reward_line",
+                "price_subtotal",
+                "product_uom_qty",
+                "order_id",
+            ]
+        )
+        self.env["sale.order"].flush(
+            ["state", "company_id", "date_order", "amount_untaxed", "currency_rate"]
+        )
+        params = {
+            "program_ids": tuple(program_ids),
+            "by_keys": bool(keys),
+            "key_program_ids": [key[0] for key in keys],
+            "key_company_ids": [key[1] for key in keys],
+            "key_dates": [key[2] for key in keys],
+            "uid": self.env.uid,
+        }
+        if keys:
+            self.env.cr.execute(
+                """
+                DELETE FROM sale_coupon_program_report r
+                USING unnest(
+                    %(key_program_ids)s::integer[],
+                    %(key_company_ids)s::integer[],
+                    %(key_dates)s::date[]
+                ) AS k(program_id, company_id, date)
+                WHERE r.coupon_program_id = k.program_id
+                    AND r.company_id = k.company_id
+                    AND r.date = k.date
+                """,
+                params,
+            )
+        else:
+            self.env.cr.execute(
+                "DELETE FROM sale_coupon_program_report "
+                "WHERE coupon_program_id IN %(program_ids)s",
+                params,
+            )
+        columns, query = self._query()
+        self.env.cr.execute(
+            sql.SQL(
+                """
+                INSERT INTO sale_coupon_program_report ({columns}, create_uid,
+                    create_date, write_uid, write_date)
+                SELECT report.*, %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s,
+                    now() AT TIME ZONE 'UTC'
+                FROM ({query}) AS report
+                """
+            ).format(
+                columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+                query=sql.SQL(query),
+            ),
+            params,
+        )
+        self.invalidate_cache()
+
+    @api.model
+    def _get_all_program_ids(self):
+        """Programs with reward lines or rows, for the first refresh"""
+        self.flush(["coupon_program_id"])
+        self.env["sale.order.line"].flush(["coupon_program_id"])
+        self.env.cr.execute(
+            """
+            SELECT coupon_program_id
+            FROM sale_order_line
+            WHERE coupon_program_id IS NOT NULL
+            UNION
+            SELECT coupon_program_id FROM sale_coupon_program_report
+            """
+        )
+        return [row[0] for row in self.env.cr.fetchall()]
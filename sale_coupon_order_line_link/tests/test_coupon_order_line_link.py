@@ -1,5 +1,7 @@
 # Copyright 2021 Tecnativa - David Vidal
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from datetime import timedelta
+
 from odoo.tests import Form, common
 
 
@@ -55,3 +57,99 @@ class TestSaleCouponCriteriaMultiProduct(common.SavepointCase):
         self.sale.recompute_coupon_lines()
         discount_line = self.sale.order_line.filtered("is_reward_line")
         self.assertEqual(discount_line.coupon_program_id, self.coupon_program)
+
+    def test_program_report(self):
+        """The programs analysis gets the confirmed orders once refreshed"""
+        report_obj = self.env["sale.coupon.program.report"]
+        report_obj._refresh()
+        self.sale.recompute_coupon_lines()
+        self.assertFalse(
+            report_obj.search([("coupon_program_id", "=", self.coupon_program.id)])
+        )
+        self.sale.action_confirm()
+        report_obj._refresh()
+        report = report_obj.search([("coupon_program_id", "=", self.coupon_program.id)])
+        self.assertEqual(report.order_count, 1)
+        self.assertAlmostEqual(report.discount_amount, 5)
+        self.assertAlmostEqual(report.reward_quantity, 1)
+        self.assertAlmostEqual(report.revenue, 45)
+        # Only the rows of the changed programs, orders and days are recomputed
+        self.coupon_program.flush()
+        self.env.cr.execute(
+            """
+            UPDATE sale_coupon_program SET write_date = write_date - interval '1 day'
+            WHERE id = %s
+            """,
+            (self.coupon_program.id,),
+        )
+        date = report.date
+        old_report = report.copy({"date": date - timedelta(days=10)})
+        report_obj._refresh()
+        self.assertTrue(old_report.exists())
+        report = report_obj.search(
+            [("coupon_program_id", "=", self.coupon_program.id), ("date", "=", date)]
+        )
+        self.assertEqual(report.order_count, 1)
+        old_report.unlink()
+        # Rows of orders no longer confirmed, or without reward lines, are removed
+        self.sale.action_cancel()
+        self.sale.action_draft()
+        self.sale.order_line.filtered("is_reward_line").unlink()
+        report_obj._refresh()
+        self.assertFalse(
+            report_obj.search([("coupon_program_id", "=", self.coupon_program.id)])
+        )
+
+    def test_backfill_coupon_program_id(self):
+        """Reward lines without program get linked to the one applied"""
+        self.sale.recompute_coupon_lines()
+        discount_line = self.sale.order_line.filtered("is_reward_line")
+        self.env.cr.execute(
+            "UPDATE sale_order_line SET coupon_program_id = NULL WHERE id = %s",
+            (discount_line.id,),
+        )
+        discount_line.invalidate_cache(["coupon_program_id"])
+        self.env["ir.config_parameter"].sudo().set_param(
+            "sale_coupon_order_line_link.backfill_last_id", 0
+        )
+        linked = self.env["sale.order.line"]._backfill_coupon_program_id(batch_size=1)
+        self.assertGreaterEqual(linked, 1)
+        self.assertEqual(discount_line.coupon_program_id, self.coupon_program)
+        last_id = self.env["ir.config_parameter"].get_param(
+            "sale_coupon_order_line_link.backfill_last_id"
+        )
+        self.assertGreaterEqual(int(last_id), discount_line.id)
+
+    def test_coupon_order_line_link_multi_tax(self):
+        """Every discount line gets linked when there are several taxes"""
+        tax_obj = self.env["account.tax"]
+        taxes = tax_obj.create(
+            [
+                {"name": "Test tax %s" % amount, "amount": amount}
+                for amount in (10, 20, 30)
+            ]
+        )
+        sale_form = Form(self.env["sale.order"])
+        sale_form.partner_id = self.partner
+        for tax in taxes:
+            with sale_form.order_line.new() as line_form:
+                line_form.product_id = self.product_a
+                line_form.product_uom_qty = 1
+                line_form.tax_id.clear()
+                line_form.tax_id.add(tax)
+        sale = sale_form.save()
+        sale.recompute_coupon_lines()
+        discount_lines = sale.order_line.filtered("is_reward_line")
+        self.assertEqual(len(discount_lines), 3)
+        self.assertEqual(
+            discount_lines.mapped("coupon_program_id"), self.coupon_program
+        )
+        self.assertEqual(discount_lines.mapped("tax_id"), taxes)
+        # Regenerated lines keep the link
+        sale.order_line.filtered(lambda x: not x.is_reward_line)[0].product_uom_qty = 2
+        sale.recompute_coupon_lines()
+        discount_lines = sale.order_line.filtered("is_reward_line")
+        self.assertEqual(len(discount_lines), 3)
+        self.assertEqual(
+            discount_lines.mapped("coupon_program_id"), self.coupon_program
+        )
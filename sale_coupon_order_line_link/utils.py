@@ -0,0 +1,22 @@
+# Copyright 2021 Tecnativa - David Vidal
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+
+def get_changes_watermark(cr):
+    """Date the next incremental refresh has to start from to get every change not
+    visible yet to the cursor. Records get the start of the transaction writing
+    them as write date, so the transactions still running could commit records
+    older than `now()`: the start of the oldest running one is returned instead.
+    Only the transactions of the same database user are seen, which are all the
+    Odoo ones.
+
+    :return: naive UTC datetime
+    """
+    cr.execute(
+        """
+        SELECT LEAST(now(), MIN(xact_start)) AT TIME ZONE 'UTC'
+        FROM pg_stat_activity
+        WHERE datname = current_database()
+        """
+    )
+    return cr.fetchone()[0]
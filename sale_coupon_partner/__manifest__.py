@@ -3,12 +3,16 @@
 
 {
     "name": "Sale Coupon Partner",
-    "version": "13.0.1.0.0",
+    "version": "13.0.1.1.0",
     "author": "Tecnativa, Odoo Community Association (OCA)",
     "website": "https://github.com/OCA/sale-promotion",
     "license": "AGPL-3",
     "category": "Marketing",
     "depends": ["sale_coupon_order_line_link"],
-    "data": ["views/sale_coupon_program_views.xml", "reports/sale_report_views.xml"],
+    "data": [
+        "data/ir_cron_data.xml",
+        "views/sale_coupon_program_views.xml",
+        "reports/sale_report_views.xml",
+    ],
     "installable": True,
 }
@@ -1,9 +1,275 @@
 # Copyright 2021 Tecnativa - Carlos Roca
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
-from odoo import fields, models
+from collections import defaultdict
+from itertools import product
+
+from psycopg2 import sql
+
+from odoo import api, fields, models
+from odoo.tools import split_every
+from odoo.tools.safe_eval import safe_eval
+
+from odoo.addons.sale_coupon_order_line_link.utils import get_changes_watermark
+
+# Partners checked at once against a partners domain
+PARTNERS_BATCH_SIZE = 10000
 
 
 class SaleCouponProgram(models.Model):
     _inherit = "sale.coupon.program"
 
-    partner_id = fields.Many2one(comodel_name="res.partner", string="Partner")
+    partner_id = fields.Many2one(
+        comodel_name="res.partner", string="Partner", index=True
+    )
+    eligible_partners_precompute = fields.Boolean(
+        string="Precompute Eligible Partners",
+        help="Store the partners matching the partners domain, so they're looked "
+        "up instead of searched every time. They're refreshed in the background, "
+        "and the partners changed since the last refresh are still searched.",
+    )
+    eligible_partner_ids = fields.Many2many(
+        comodel_name="res.partner",
+        relation="sale_coupon_program_eligible_partner_rel",
+        column1="program_id",
+        column2="partner_id",
+        string="Eligible Partners",
+        readonly=True,
+        copy=False,
+    )
+    eligible_partners_date = fields.Datetime(
+        string="Eligible Partners Date",
+        readonly=True,
+        copy=False,
+        help="Last refresh of the eligible partners",
+    )
+
+    def write(self, vals):
+        if {"rule_partners_domain", "eligible_partners_precompute"} & set(vals):
+            self.filtered("eligible_partners_date")._clear_eligible_partners()
+        return super().write(vals)
+
+    def _get_eligible_partner_pairs(self, partners):
+        """Tell which of the partners are eligible for every program, looking them
+        up for the programs with precomputed partners and searching them for the
+        rest.
+
+        :return: set of tuples (program id, partner id)
+        """
+        precomputed = self.filtered("eligible_partners_date")
+        pairs = (self - precomputed)._search_eligible_partner_pairs(partners)
+        if precomputed:
+            pairs |= precomputed._read_eligible_partner_pairs(partners)
+        return pairs
+
+    def _search_eligible_partner_pairs(self, partners):
+        """The programs are grouped by their partners domain, and all the distinct
+        domains are checked at once for the given partners: each of them is a
+        boolean column of a single query per batch of partners.
+
+        :return: set of tuples (program id, partner id)
+        """
+        programs_by_domain = defaultdict(list)
+        for program in self:
+            programs_by_domain[program.rule_partners_domain or "[]"].append(program.id)
+        pairs = set()
+        domains = []
+        for domain, program_ids in programs_by_domain.items():
+            domain = safe_eval(domain)
+            if domain:
+                domains.append((domain, program_ids))
+            else:
+                pairs.update(product(program_ids, partners.ids))
+        if not domains or not partners:
+            return pairs
+        partner_obj = self.env["res.partner"]
+        columns, params = [], []
+        for domain, _program_ids in domains:
+            partner_obj._flush_search(domain)
+            query = partner_obj._where_calc(domain)
+            partner_obj._apply_ir_rules(query, "read")
+            from_clause, where_clause, where_params = query.get_sql()
+            columns.append(
+                sql.SQL(
+                    'EXISTS (SELECT 1 FROM {} WHERE ({}) AND "res_partner".id = p.id)'
+                ).format(sql.SQL(from_clause), sql.SQL(where_clause or "TRUE"))
+            )
+            params += where_params
+        query = sql.SQL("SELECT p.id, {} FROM res_partner p WHERE p.id IN %s").format(
+            sql.SQL(", ").join(columns)
+        )
+        for ids in split_every(PARTNERS_BATCH_SIZE, partners.ids, tuple):
+            self.env.cr.execute(query, params + [ids])
+            for row in self.env.cr.fetchall():
+                for (_domain, program_ids), eligible in zip(domains, row[1:]):
+                    if eligible:
+                        pairs.update(product(program_ids, [row[0]]))
+        return pairs
+
+    def _read_eligible_partner_pairs(self, partners):
+        """Precomputed eligible partners. The partners changed since the programs
+        refresh are searched, as they could have become eligible or not.
+
+        :return: set of tuples (program id, partner id)
+        """
+        self.flush(["eligible_partner_ids", "eligible_partners_date"])
+        partners.flush(["write_date"])
+        pairs = set()
+        changed_pairs = set()
+        for ids in split_every(PARTNERS_BATCH_SIZE, partners.ids, tuple):
+            # Stored eligible partners not changed since, and changed partners
+            self.env.cr.execute(
+                """
+                SELECT p.id, rp.id, rp.write_date >= p.eligible_partners_date
+                FROM sale_coupon_program p
+                JOIN res_partner rp ON rp.id IN %(partner_ids)s
+                WHERE p.id IN %(program_ids)s
+                    AND (
+                        rp.write_date >= p.eligible_partners_date
+                        OR EXISTS (
+                            SELECT 1 FROM sale_coupon_program_eligible_partner_rel r
+                            WHERE r.program_id = p.id AND r.partner_id = rp.id
+                        )
+                    )
+                """,
+                {"program_ids": tuple(self.ids), "partner_ids": ids},
+            )
+            for program_id, partner_id, changed in self.env.cr.fetchall():
+                (changed_pairs if changed else pairs).add((program_id, partner_id))
+        if changed_pairs:
+            programs = self.browse({pair[0] for pair in changed_pairs})
+            changed = partners.browse({pair[1] for pair in changed_pairs})
+            pairs.update(
+                changed_pairs & programs._search_eligible_partner_pairs(changed)
+            )
+        return pairs
+
+    def _clear_eligible_partners(self):
+        if not self:
+            return
+        self.env.cr.execute(
+            """
+            DELETE FROM sale_coupon_program_eligible_partner_rel
+            WHERE program_id IN %s
+            """,
+            (tuple(self.ids),),
+        )
+        self.invalidate_cache(["eligible_partner_ids"], self.ids)
+        self.write({"eligible_partners_date": False})
+
+    @api.model
+    def _refresh_eligible_partners(self, batch_size=PARTNERS_BATCH_SIZE, commit=False):
+        """Update the eligible partners of the programs to precompute with the
+        partners changed since their last refresh, or with all of them on the first
+        one. The changed partners are selected once for all the programs, and the
+        partners are checked in batches following their ids, for all the programs
+        at once, so the job can be committed between batches and run in the
+        background.
+
+        :param batch_size: number of partners checked at once
+        :param commit: commit every batch
+        """
+        cr = self.env.cr
+        programs = self.search([("eligible_partners_precompute", "=", True)])
+        # Partners written by transactions still running when the refresh starts
+        # are checked again on the next one
+        refresh_date = get_changes_watermark(cr)
+        self.env["res.partner"].flush(["write_date"])
+        new_programs = programs.filtered(lambda x: not x.eligible_partners_date)
+        if new_programs:
+            last_id = 0
+            while True:
+                cr.execute(
+                    """
+                    SELECT id, NULL FROM res_partner
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    (last_id, batch_size),
+                )
+                rows = cr.fetchall()
+                if not rows:
+                    break
+                new_programs._refresh_eligible_partners_batch(rows)
+                last_id = rows[-1][0]
+                if commit:
+                    cr.commit()  # pylint: disable=invalid-commit
+        programs -= new_programs
+        if programs:
+            cr.execute(
+                """
+                SELECT id, write_date FROM res_partner
+                WHERE write_date >= %s
+                ORDER BY id
+                """,
+                (min(programs.mapped("eligible_partners_date")),),
+            )
+            for rows in split_every(batch_size, cr.fetchall(), list):
+                programs._refresh_eligible_partners_batch(rows)
+                if commit:
+                    cr.commit()  # pylint: disable=invalid-commit
+        programs |= new_programs
+        programs.invalidate_cache(["eligible_partner_ids"], programs.ids)
+        programs.write({"eligible_partners_date": refresh_date})
+        if commit:
+            cr.commit()  # pylint: disable=invalid-commit
+
+    def _refresh_eligible_partners_batch(self, rows):
+        """Store which of the partners are eligible for the programs, among those
+        changed since every program refresh.
+
+        :param rows: list of tuples (partner id, write date), without write date
+          for the programs first refresh
+        """
+        partners = self.env["res.partner"].browse([row[0] for row in rows])
+        eligible_pairs = self._search_eligible_partner_pairs(partners)
+        checked_pairs = [
+            (program.id, partner_id)
+            for program in self
+            for partner_id, write_date in rows
+            if not write_date or write_date >= program.eligible_partners_date
+        ]
+        params = {
+            "program_ids": [pair[0] for pair in checked_pairs],
+            "partner_ids": [pair[1] for pair in checked_pairs],
+            "eligible_program_ids": [],
+            "eligible_partner_ids": [],
+        }
+        for pair in checked_pairs:
+            if pair in eligible_pairs:
+                params["eligible_program_ids"].append(pair[0])
+                params["eligible_partner_ids"].append(pair[1])
+        self.env.cr.execute(
+            """
+            DELETE FROM sale_coupon_program_eligible_partner_rel r
+            USING unnest(%(program_ids)s::integer[], %(partner_ids)s::integer[])
+                AS k(program_id, partner_id)
+            WHERE r.program_id = k.program_id AND r.partner_id = k.partner_id
+            """,
+            params,
+        )
+        self.env.cr.execute(
+            """
+            INSERT INTO sale_coupon_program_eligible_partner_rel
+                (program_id, partner_id)
+            SELECT * FROM unnest(
+                %(eligible_program_ids)s::integer[],
+                %(eligible_partner_ids)s::integer[]
+            )
+            """,
+            params,
+        )
+        partners.invalidate_cache(ids=partners.ids)
+
+    def _is_valid_partner(self, partner):
+        if not self.eligible_partners_date:
+            return super()._is_valid_partner(partner)
+        return bool(self._filter_valid_partner(partner))
+
+    def _filter_valid_partner(self, partner):
+        """Batch version of `_is_valid_partner`
+
+        :return: programs valid for the partner
+        """
+        pairs = self._get_eligible_partner_pairs(partner)
+        return self.filtered(lambda x: (x.id, partner.id) in pairs)
@@ -0,0 +1,22 @@
+# Copyright 2021 Tecnativa - Carlos Roca
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import fields, models
+
+
+class SaleCouponProgramReport(models.Model):
+    _inherit = "sale.coupon.program.report"
+
+    coupon_program_partner_id = fields.Many2one(
+        comodel_name="res.partner", string="Coupon Program Partner", readonly=True,
+    )
+
+    def _query(self, fields=None, groupby="", from_clause=""):
+        if fields is None:
+            fields = {}
+        fields.update({"coupon_program_partner_id": "scp.partner_id"})
+        from_clause += (
+            "left join sale_coupon_program scp on (po.coupon_program_id = scp.id)"
+        )
+        groupby += ", scp.partner_id"
+        return super()._query(fields=fields, groupby=groupby, from_clause=from_clause,)
@@ -0,0 +1 @@
+from . import test_sale_coupon_partner
@@ -0,0 +1,100 @@
+# Copyright 2021 Tecnativa - Carlos Roca
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from odoo.tests import common
+
+
+class TestSaleCouponPartner(common.SavepointCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        program_obj = cls.env["sale.coupon.program"]
+        cls.partner_admin = cls.env.ref("base.user_admin").partner_id
+        cls.partner_portal = cls.env.ref("base.demo_user0").partner_id
+        cls.program_all = program_obj.create(
+            {
+                "program_type": "promotion_program",
+                "name": "Test 01",
+                "rule_partners_domain": "[]",
+            }
+        )
+        cls.program_admin = program_obj.create(
+            {
+                "program_type": "promotion_program",
+                "name": "Test 02",
+                "rule_partners_domain": "[['id', '=', %s]]" % cls.partner_admin.id,
+            }
+        )
+        cls.program_portal = program_obj.create(
+            {
+                "program_type": "promotion_program",
+                "name": "Test 03",
+                "rule_partners_domain": "[['id', '=', %s]]" % cls.partner_portal.id,
+            }
+        )
+        cls.programs = cls.program_all + cls.program_admin + cls.program_portal
+
+    def test_filter_valid_partner(self):
+        """Programs are filtered by their partners domain"""
+        self.assertEqual(
+            self.programs._filter_valid_partner(self.partner_admin),
+            self.program_all + self.program_admin,
+        )
+        self.assertEqual(
+            self.programs._filter_valid_partner(self.partner_portal),
+            self.program_all + self.program_portal,
+        )
+
+    def test_eligible_partner_pairs(self):
+        """Eligible partners of many programs are worked out at once"""
+        partners = self.partner_admin + self.partner_portal
+        self.assertEqual(
+            self.programs._get_eligible_partner_pairs(partners),
+            {
+                (self.program_all.id, self.partner_admin.id),
+                (self.program_all.id, self.partner_portal.id),
+                (self.program_admin.id, self.partner_admin.id),
+                (self.program_portal.id, self.partner_portal.id),
+            },
+        )
+
+    def test_eligible_partners_precompute(self):
+        """Precomputed eligible partners are looked up"""
+        partners = self.partner_admin + self.partner_portal
+        self.program_admin.eligible_partners_precompute = True
+        self.env["sale.coupon.program"]._refresh_eligible_partners(batch_size=5)
+        self.assertTrue(self.program_admin.eligible_partners_date)
+        self.assertEqual(self.program_admin.eligible_partner_ids, self.partner_admin)
+        self.assertEqual(
+            self.program_admin._get_eligible_partner_pairs(partners),
+            {(self.program_admin.id, self.partner_admin.id)},
+        )
+        self.assertTrue(self.program_admin._is_valid_partner(self.partner_admin))
+        self.assertFalse(self.program_admin._is_valid_partner(self.partner_portal))
+        # A new domain is searched until the next refresh
+        self.program_admin.rule_partners_domain = (
+            "[('id', '=', %s)]" % self.partner_portal.id
+        )
+        self.assertFalse(self.program_admin.eligible_partners_date)
+        self.assertFalse(self.program_admin.eligible_partner_ids)
+        self.assertTrue(self.program_admin._is_valid_partner(self.partner_portal))
+
+    def test_eligible_partners_refresh(self):
+        """Partners changed since the refresh are searched, then stored"""
+        partners = self.partner_admin + self.partner_portal
+        self.program_admin.write(
+            {
+                "rule_partners_domain": "[['ref', '=', 'TEST-ELIGIBLE']]",
+                "eligible_partners_precompute": True,
+            }
+        )
+        self.partner_admin.ref = "TEST-ELIGIBLE"
+        self.env["sale.coupon.program"]._refresh_eligible_partners(batch_size=5)
+        self.assertEqual(self.program_admin.eligible_partner_ids, self.partner_admin)
+        self.partner_admin.ref = False
+        self.partner_portal.ref = "TEST-ELIGIBLE"
+        self.assertEqual(
+            self.program_admin._get_eligible_partner_pairs(partners),
+            {(self.program_admin.id, self.partner_portal.id)},
+        )
+        self.env["sale.coupon.program"]._refresh_eligible_partners(batch_size=5)
+        self.assertEqual(self.program_admin.eligible_partner_ids, self.partner_portal)
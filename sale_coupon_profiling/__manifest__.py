@@ -0,0 +1,15 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+{
+    "name": "Coupons profiling",
+    "summary": "Measure the time and queries spent by the coupon programs",
+    "version": "13.0.1.0.0",
+    "category": "Sale",
+    "website": "https://github.com/OCA/sale-promotion",
+    "author": "Odoo Community Association (OCA)",
+    "license": "AGPL-3",
+    "depends": ["sale_coupon"],
+    "data": [
+        "security/ir.model.access.csv",
+        "views/sale_coupon_profiling_stat_views.xml",
+    ],
+}
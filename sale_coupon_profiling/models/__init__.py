@@ -0,0 +1 @@
+from . import sale_coupon_profiling_stat
@@ -0,0 +1,34 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from odoo import fields, models
+
+
+class SaleCouponProfilingStat(models.Model):
+    """Time, queries and records of the profiled methods by program and day. It's
+    filled with plain SQL once the transactions making the calls are committed."""
+
+    _name = "sale.coupon.profiling.stat"
+    _description = "Coupon Programs Profiling Statistic"
+    _log_access = False
+    _order = "date desc, name, program_id"
+
+    name = fields.Char(string="Method", required=True, readonly=True)
+    program_id = fields.Many2one(
+        comodel_name="sale.coupon.program",
+        string="Coupon Program",
+        readonly=True,
+        ondelete="cascade",
+    )
+    date = fields.Date(required=True, readonly=True)
+    call_count = fields.Integer(string="Calls", readonly=True)
+    duration = fields.Float(string="Duration (ms)", readonly=True)
+    query_count = fields.Float(string="Queries", readonly=True)
+    record_count = fields.Float(string="Records", readonly=True)
+
+    def init(self):
+        """The aggregates are added to the existing ones of the same key"""
+        self.env.cr.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS sale_coupon_profiling_stat_key_index
+            ON sale_coupon_profiling_stat (name, (COALESCE(program_id, 0)), date)
+            """
+        )
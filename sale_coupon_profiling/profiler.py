@@ -0,0 +1,137 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import functools
+import logging
+import time
+from collections import defaultdict
+
+from odoo.http import request
+
+from .transaction_buffer import TransactionBuffer
+
+_logger = logging.getLogger(__name__)
+
+
+def profiled(programs=None, records=None):
+    """Measure the wall time, the SQL queries and the records touched by every call
+    of the decorated method, but only when this module logger is enabled at DEBUG
+    level. The functions getting the programs and the records are only called then,
+    after the measure.
+
+    Lazy QWeb responses are measured once rendered.
+
+    :param programs: function of the method arguments and its ``result`` keyword
+      returning the programs involved, as a recordset or a list of ids
+    :param records: function of the method arguments and its ``result`` keyword
+      returning the records touched, as a recordset or a list
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not _logger.isEnabledFor(logging.DEBUG):
+                return method(self, *args, **kwargs)
+            env = getattr(self, "env", None) or request.env
+            start, queries = time.perf_counter(), env.cr.sql_log_count
+
+            def record(result):
+                duration = (time.perf_counter() - start) * 1000
+                call_queries = env.cr.sql_log_count - queries
+                program_ids = (
+                    programs(self, *args, result=result, **kwargs) if programs else []
+                )
+                record_count = (
+                    len(records(self, *args, result=result, **kwargs)) if records else 0
+                )
+                _record_stats(
+                    env.cr,
+                    method.__name__,
+                    getattr(program_ids, "ids", program_ids),
+                    duration,
+                    call_queries,
+                    record_count,
+                )
+
+            result = method(self, *args, **kwargs)
+            if getattr(result, "is_qweb", False) and result.template:
+                flatten = result.flatten
+
+                def profiled_flatten():
+                    if not result.template:
+                        return flatten()
+                    res = flatten()
+                    record(result)
+                    return res
+
+                result.flatten = profiled_flatten
+            else:
+                record(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _record_stats(cr, name, program_ids, duration, queries, records):
+    """Log the call and add it to the aggregates of every program involved"""
+    _logger.debug(
+        "%s: %s programs, %.3f ms, %s queries, %s records",
+        name,
+        len(program_ids),
+        duration,
+        queries,
+        records,
+    )
+    share = 1.0 / (len(program_ids) or 1)
+
+    def update(stats):
+        for program_id in program_ids or [False]:
+            values = stats[name, program_id]
+            values[0] += 1
+            values[1] += duration * share
+            values[2] += queries * share
+            values[3] += records * share
+
+    _stats.add(cr, update)
+
+
+def _write_stats(cr, stats):
+    """Add the aggregates to the stored ones"""
+    rows = [
+        (name, program_id or None, *values)
+        for (name, program_id), values in stats.items()
+    ]
+    cr.execute(
+        """
+        INSERT INTO sale_coupon_profiling_stat AS s
+            (name, program_id, date, call_count, duration, query_count, record_count)
+        SELECT r.name, r.program_id, (now() AT TIME ZONE 'UTC')::date, r.calls,
+            r.duration, r.queries, r.records
+        FROM unnest(
+            %s::varchar[], %s::integer[], %s::integer[], %s::float[], %s::float[],
+            %s::float[]
+        ) AS r(name, program_id, calls, duration, queries, records)
+        WHERE r.program_id IS NULL
+            OR EXISTS (SELECT 1 FROM sale_coupon_program p WHERE p.id = r.program_id)
+        ON CONFLICT (name, (COALESCE(program_id, 0)), date) DO UPDATE
+        SET call_count = s.call_count + EXCLUDED.call_count,
+            duration = s.duration + EXCLUDED.duration,
+            query_count = s.query_count + EXCLUDED.query_count,
+            record_count = s.record_count + EXCLUDED.record_count
+        """,
+        [list(column) for column in zip(*rows)],
+    )
+
+
+# Aggregates not stored yet, by database:
+# (method, program id) -> [calls, duration in ms, queries, records]
+_stats = TransactionBuffer(
+    "Coupon programs profiling stats",
+    _write_stats,
+    lambda: defaultdict(lambda: [0, 0.0, 0.0, 0.0]),
+)
+
+
+def flush_profiling_stats(cr):
+    """Add the aggregates buffered for the cursor database to the stored ones"""
+    _stats.flush(cr)
@@ -0,0 +1,47 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+from odoo.tests import common
+
+from ..profiler import flush_profiling_stats, profiled
+
+
+@profiled(
+    programs=lambda programs, result: programs, records=lambda programs, result: result,
+)
+def _search_programs(programs):
+    return programs.search([("id", "in", programs.ids)])
+
+
+class TestSaleCouponProfiling(common.SavepointCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.programs = cls.env["sale.coupon.program"].create(
+            [{"name": "Profiled program 1"}, {"name": "Profiled program 2"}]
+        )
+        cls.stat_obj = cls.env["sale.coupon.profiling.stat"]
+
+    def test_profiled(self):
+        """Calls are only measured with the logger enabled, and shared evenly
+        between their programs"""
+        self.assertEqual(_search_programs(self.programs), self.programs)
+        flush_profiling_stats(self.env.cr)
+        self.assertFalse(self.stat_obj.search([("name", "=", "_search_programs")]))
+        with self.assertLogs("odoo.addons.sale_coupon_profiling", "DEBUG"):
+            _search_programs(self.programs)
+            _search_programs(self.programs[0])
+        flush_profiling_stats(self.env.cr)
+        stats = self.stat_obj.search([("name", "=", "_search_programs")])
+        self.assertEqual(stats.mapped("program_id"), self.programs)
+        stat_1 = stats.filtered(lambda x: x.program_id == self.programs[0])
+        stat_2 = stats - stat_1
+        self.assertEqual(stat_1.call_count, 2)
+        self.assertEqual(stat_2.call_count, 1)
+        self.assertAlmostEqual(stat_1.record_count, 2)
+        self.assertAlmostEqual(stat_2.record_count, 1)
+        self.assertGreater(stat_1.query_count, stat_2.query_count)
+        # Later calls are added to the same aggregates
+        with self.assertLogs("odoo.addons.sale_coupon_profiling", "DEBUG"):
+            _search_programs(self.programs[1])
+        flush_profiling_stats(self.env.cr)
+        stat_2.invalidate_cache()
+        self.assertEqual(stat_2.call_count, 2)
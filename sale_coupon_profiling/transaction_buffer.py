@@ -0,0 +1,75 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import functools
+import logging
+import threading
+import weakref
+
+from odoo.sql_db import db_connect
+
+_logger = logging.getLogger(__name__)
+
+
+class TransactionBuffer:
+    """Data buffered by database in every process and written with a cursor of its
+    own once the transaction adding it ends, so that transaction doesn't write it
+    itself nor has to wait for it.
+
+    :param name: description of the data for the logs
+    :param write: function of a cursor and the data of its database writing it
+    :param factory: function returning the empty data of a database
+    :param events: events of the cursors adding data which write it: ``commit``,
+      ``rollback`` or both. After any other one the data is kept for the next
+      transaction.
+    """
+
+    def __init__(self, name, write, factory, events=("commit",)):
+        self.name = name
+        self._write = write
+        self._factory = factory
+        self._events = events
+        self._data = {}
+        self._lock = threading.Lock()
+        # Cursors which transaction end will write the buffered data
+        self._hooked_cursors = weakref.WeakSet()
+
+    def add(self, cr, update):
+        """Update the data of the cursor database and write it once its current
+        transaction ends.
+
+        :param update: function of the data updating it, called with the buffer
+          locked
+        """
+        with self._lock:
+            update(self._data.setdefault(cr.dbname, self._factory()))
+            if cr in self._hooked_cursors:
+                return
+            self._hooked_cursors.add(cr)
+        for event in ("commit", "rollback"):
+            if event in self._events:
+                callback = functools.partial(self._write_after_transaction, cr)
+            else:
+                callback = functools.partial(self._hooked_cursors.discard, cr)
+            cr.after(event, callback)
+
+    def pop(self, dbname):
+        """Take out the data buffered for the database"""
+        with self._lock:
+            return self._data.pop(dbname, None) or self._factory()
+
+    def flush(self, cr):
+        """Write the data buffered for the cursor database with it"""
+        data = self.pop(cr.dbname)
+        if data:
+            self._write(cr, data)
+
+    def _write_after_transaction(self, cr):
+        """The ended transaction cursor can't be used anymore for it"""
+        self._hooked_cursors.discard(cr)
+        data = self.pop(cr.dbname)
+        if not data:
+            return
+        try:
+            with db_connect(cr.dbname).cursor() as write_cr:
+                self._write(write_cr, data)
+        except Exception:
+            _logger.warning("%s not written", self.name, exc_info=True)
@@ -12,6 +12,7 @@ setuptools.setup(
         'odoo13-addon-sale_coupon_mass_mailing',
         'odoo13-addon-sale_coupon_order_line_link',
         'odoo13-addon-sale_coupon_partner',
+        'odoo13-addon-sale_coupon_profiling',
         'odoo13-addon-website_sale_coupon_page',
     ],
     classifiers=[
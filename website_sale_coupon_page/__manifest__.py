@@ -3,14 +3,14 @@
 
 {
     "name": "Website Sale Coupon Page",
-    "version": "13.0.1.0.0",
+    "version": "13.0.1.1.0",
     "category": "Website",
     "website": "https://github.com/OCA/sale-promotion",
     "author": "Tecnativa, Odoo Community Association (OCA)",
     "license": "LGPL-3",
     "application": False,
     "installable": True,
-    "depends": ["website_sale_coupon"],
+    "depends": ["website_sale_coupon", "sale_coupon_partner", "sale_coupon_profiling"],
     "data": [
         "templates/assets.xml",
         "views/sale_coupon_program_views.xml",
@@ -1,32 +1,136 @@
 # Copyright 2021 Tecnativa - Carlos Roca
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+import hashlib
+
 from odoo import http
 from odoo.http import request
 
+from odoo.addons.sale_coupon_profiling.profiler import profiled
+
+
+def _get_rendered_promotion_ids(response):
+    """Programs rendered in a promotions page response"""
+    qcontext = getattr(response, "qcontext", None) or {}
+    return [promo["id"] for promo in qcontext.get("promos", ())]
+
 
 class WebsiteSale(http.Controller):
-    @http.route(["""/promotions"""], type="http", auth="public", website=True)
-    def promotion(self, **post):
-        all_promos = (
-            request.env["sale.coupon.program"]
+    def _get_promotions_per_page(self):
+        return int(
+            request.env["ir.config_parameter"]
+            .sudo()
+            .get_param("website_sale_coupon_page.promotions_per_page", 24)
+        )
+
+    def _get_promotions_max_age(self):
+        return int(
+            request.env["ir.config_parameter"]
             .sudo()
-            .search(
-                [
-                    ("is_published", "=", True),
-                    "|",
-                    ("website_id", "=", False),
-                    ("website_id", "=", request.env.context.get("website_id")),
-                ]
-            )
-        )
-        values = {"promos": []}
-        for promo in all_promos:
-            if promo._is_valid_partner(request.env.user.partner_id):
-                values["promos"].append(
-                    {
-                        "id": promo.id,
-                        "image_1920": promo.image_1920,
-                        "public_name": promo.public_name,
-                    }
-                )
-        return request.render("website_sale_coupon_page.promotion_layout", values)
+            .get_param("website_sale_coupon_page.promotions_max_age", 60)
+        )
+
+    def _get_promotions_pager(self, promos, page):
+        """The pager takes any page given and keeps it between the first and the
+        last one."""
+        return request.website.pager(
+            url="/promotions",
+            total=len(promos),
+            page=page,
+            step=self._get_promotions_per_page(),
+        )
+
+    def _get_valid_promotions(self):
+        """Published promotions of the current website valid for the current user
+
+        :return: list of tuples (program id, public name, has image)
+        """
+        program_obj = request.env["sale.coupon.program"].sudo()
+        all_promos = program_obj._get_published_promotions(
+            request.env.context.get("website_id")
+        )
+        valid_promo_ids = set(
+            program_obj.browse([promo[0] for promo in all_promos])
+            ._filter_valid_partner(request.env.user.partner_id)
+            .ids
+        )
+        return [promo for promo in all_promos if promo[0] in valid_promo_ids]
+
+    def _prepare_promotions_values(self, promos):
+        return [
+            {"id": promo_id, "has_image": has_image, "public_name": public_name}
+            for promo_id, public_name, has_image in promos
+        ]
+
+    def _get_promotions_etag(self, promos, pager):
+        """Tag of the page contents, so repeated visits can be answered with a 304
+        until any shown promotion, the number of pages or any cached view
+        changes."""
+        key = (
+            request.env.registry.cache_sequence,
+            request.env.context.get("website_id"),
+            request.env.context.get("lang"),
+            pager["page"]["num"],
+            pager["page_count"],
+            promos,
+        )
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def _is_promotions_page_cacheable(self):
+        """Only anonymous visitors without cart get the same page every time, as
+        the layout shows data from the user and the cart otherwise."""
+        return request.website.is_public_user() and not request.session.get(
+            "sale_order_id"
+        )
+
+    @http.route(
+        ["/promotions", "/promotions/page/<int:page>"],
+        type="http",
+        auth="public",
+        website=True,
+    )
+    @profiled(
+        programs=lambda self, result, **kwargs: _get_rendered_promotion_ids(result),
+        records=lambda self, result, **kwargs: _get_rendered_promotion_ids(result),
+    )
+    def promotion(self, page=1, **post):
+        promos = self._get_valid_promotions()
+        pager = self._get_promotions_pager(promos, page)
+        page_promos = promos[pager["offset"] : pager["offset"] + pager["limit"]]
+        headers = {}
+        if self._is_promotions_page_cacheable():
+            etag = self._get_promotions_etag(page_promos, pager)
+            max_age = self._get_promotions_max_age()
+            # Shared caches keep it for anonymous visitors only: the session cookie
+            # tells them apart from the logged in users.
+            headers = {
+                "ETag": '"%s"' % etag,
+                "Cache-Control": "public, max-age=%d, s-maxage=%d" % (max_age, max_age),
+                "Vary": "Cookie",
+            }
+            if etag in request.httprequest.if_none_match:
+                return request.make_response("", headers=headers, status=304)
+        values = {
+            "promos": self._prepare_promotions_values(page_promos),
+            "pager": pager,
+            "next_page": pager["page"]["num"] < pager["page_count"]
+            and pager["page"]["num"] + 1,
+        }
+        return request.render(
+            "website_sale_coupon_page.promotion_layout", values, headers=headers
+        )
+
+    @http.route(["/promotions/load"], type="json", auth="public", website=True)
+    def promotion_load(self, page=1, **post):
+        """Chunk of promotion cards for the infinite scroll of the page"""
+        promos = self._get_valid_promotions()
+        pager = self._get_promotions_pager(promos, page)
+        page_promos = promos[pager["offset"] : pager["offset"] + pager["limit"]]
+        html = request.env["ir.ui.view"].render_template(
+            "website_sale_coupon_page.promotion_items",
+            {"promos": self._prepare_promotions_values(page_promos)},
+        )
+        return {
+            "html": html,
+            "next_page": pager["page"]["num"] < pager["page_count"]
+            and pager["page"]["num"] + 1,
+        }
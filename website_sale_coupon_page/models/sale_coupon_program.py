@@ -1,7 +1,7 @@
 # Copyright 2021 Tecnativa - Carlos Roca
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
-from odoo import fields, models
+from odoo import api, fields, models, tools
 
 
 class SaleCouponProgram(models.Model):
@@ -12,3 +12,57 @@ class SaleCouponProgram(models.Model):
         string="Public Name",
         help="Name of the promo showed on website bellow the banner image.",
     )
+
+    @api.model
+    def _get_published_promotions_fields(self):
+        """Fields the published promotions catalog depends on"""
+        return {
+            "active",
+            "is_published",
+            "website_id",
+            "public_name",
+            "image_1920",
+            "sequence",
+            "program_type",
+        }
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        # The whole registry cache is cleared on every worker, so only when needed
+        if any(vals.get("is_published") for vals in vals_list):
+            self.clear_caches()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if self._get_published_promotions_fields() & set(vals) and (
+            vals.get("is_published") or any(self.mapped("is_published"))
+        ):
+            self.clear_caches()
+        return super().write(vals)
+
+    def unlink(self):
+        if any(self.mapped("is_published")):
+            self.clear_caches()
+        return super().unlink()
+
+    @api.model
+    @tools.ormcache("website_id")
+    def _get_published_promotions(self, website_id):
+        """Catalog of the promotions published in the website, cached until any of
+        them changes.
+
+        :return: tuple of tuples (program id, public name, has image)
+        """
+        programs = self.sudo().search(
+            [
+                ("is_published", "=", True),
+                "|",
+                ("website_id", "=", False),
+                ("website_id", "=", website_id),
+            ]
+        )
+        # With bin_size only the images size is read, not their content
+        return tuple(
+            (program.id, program.public_name, bool(program.image_1920))
+            for program in programs.with_context(bin_size=True)
+        )
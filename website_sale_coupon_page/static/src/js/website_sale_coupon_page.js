@@ -0,0 +1,92 @@
+/* Copyright 2021 Tecnativa - Carlos Roca
+ * License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl). */
+
+odoo.define("website_sale_coupon_page.promotion_modal", function(require) {
+    "use strict";
+
+    const publicWidget = require("web.public.widget");
+
+    publicWidget.registry.PromotionModal = publicWidget.Widget.extend({
+        selector: ".o_promotion_modal",
+        events: {
+            "show.bs.modal": "_onShowModal",
+        },
+
+        /**
+         * Load the full size banner only when the promotion is opened
+         *
+         * @private
+         */
+        _onShowModal: function() {
+            this.$("img[data-src]").each(function() {
+                this.src = this.dataset.src;
+                this.removeAttribute("data-src");
+            });
+        },
+    });
+
+    publicWidget.registry.PromotionsInfiniteScroll = publicWidget.Widget.extend({
+        selector: ".o_promotions",
+
+        /**
+         * Load the next pages of promotions as the end of the list is reached.
+         * The pager stays as fallback for browsers without IntersectionObserver.
+         *
+         * @override
+         */
+        start: function() {
+            this.nextPage = this.$el.data("next-page");
+            if (this.nextPage && window.IntersectionObserver) {
+                this.$(".o_promotions_pager").addClass("d-none");
+                this.observer = new IntersectionObserver(
+                    this._onIntersection.bind(this),
+                    {rootMargin: "200px"}
+                );
+                this.observer.observe(this.el.querySelector(".o_promotions_end"));
+            }
+            return this._super.apply(this, arguments);
+        },
+        /**
+         * @override
+         */
+        destroy: function() {
+            if (this.observer) {
+                this.observer.disconnect();
+            }
+            this._super.apply(this, arguments);
+        },
+
+        /**
+         * @private
+         * @returns {Promise}
+         */
+        _loadNextPage: function() {
+            this.loading = true;
+            return this._rpc({
+                route: "/promotions/load",
+                params: {page: this.nextPage},
+            })
+                .then(result => {
+                    const $items = $(result.html);
+                    this.$(".o_promotions_row").append($items);
+                    this.trigger_up("widgets_start_request", {$target: $items});
+                    this.nextPage = result.next_page;
+                    if (!this.nextPage) {
+                        this.observer.disconnect();
+                    }
+                })
+                .finally(() => {
+                    this.loading = false;
+                });
+        },
+        /**
+         * @private
+         * @param {IntersectionObserverEntry[]} entries
+         */
+        _onIntersection: function(entries) {
+            if (!this.loading && this.nextPage && entries[0].isIntersecting) {
+                this._loadNextPage();
+            }
+        },
+    });
+});
@@ -2,6 +2,7 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 import base64
 import io
+import json
 
 from PIL import Image
 
@@ -56,3 +57,43 @@ class WebsiteSaleHttpCase(HttpCase):
         self.start_tour(
             "/promotions", "website_sale_coupon_page_portal", login="portal",
         )
+
+    def test_published_promotions(self):
+        """The published promotions catalog follows the programs changes"""
+        program_obj = self.env["sale.coupon.program"]
+        promos = program_obj._get_published_promotions(False)
+        self.assertIn((self.promo_public.id, "10% discount", True), promos)
+        self.assertIn(
+            (self.promo_private.id, "10% discount just for admin", False), promos
+        )
+        self.assertNotIn(self.promo_not_published.id, [promo[0] for promo in promos])
+        self.promo_not_published.is_published = True
+        self.promo_public.public_name = "20% discount"
+        promos = program_obj._get_published_promotions(False)
+        self.assertIn(self.promo_not_published.id, [promo[0] for promo in promos])
+        self.assertIn((self.promo_public.id, "20% discount", True), promos)
+
+    def test_promotions_pagination(self):
+        """Promotions are paginated and anonymous visits answered with a 304 while
+        they don't change"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "website_sale_coupon_page.promotions_per_page", 1
+        )
+        response = self.url_open("/promotions")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("/promotions/page/2", response.text)
+        self.assertTrue(response.headers["Cache-Control"].startswith("public"))
+        etag = response.headers["ETag"]
+        response = self.url_open("/promotions", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.promo_public.public_name = "15% discount"
+        response = self.url_open("/promotions", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("15% discount", response.text)
+        # Any page asked is kept between the first and the last one
+        response = self.url_open(
+            "/promotions/load",
+            data=json.dumps({"params": {"page": "-1"}}),
+            headers={"Content-Type": "application/json"},
+        )
+        self.assertEqual(response.json()["result"]["next_page"], 2)